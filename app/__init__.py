@@ -1,20 +1,47 @@
 from flask import Flask, request
 from config import Config 
+from app.replicas import RoutingSession, replica_router
+from app.invalidation import InvalidationBus
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager 
 from flask_mail import Mail
-import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler 
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.middleware.proxy_fix import ProxyFix
+from app.logs import init_logging
+from app.profiling import init_profiling
+from app.admission import admission_controller
 import os
 
 app = Flask(__name__)
 app.config.from_object(Config)
-db = SQLAlchemy(app)
+if not app.debug:
+    # before admission control, so requests it rejects are logged with their id and latency as well
+    init_logging(app)
+    app.logger.info('Polyglotpivot startup')
+admission_controller.init_app(app)  # first hook after the request log, so rejected requests do no other work
+if app.config['TRUSTED_PROXIES']:
+    # request.remote_addr is the address of the client, not of the proxy (e.g. for the token buckets)
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'], x_proto=app.config['TRUSTED_PROXIES'])
+
+# keep compiled templates on disk, so new workers start with warm templates 
+if app.config['TEMPLATE_BYTECODE_CACHE_DIR']:
+    os.makedirs(app.config['TEMPLATE_BYTECODE_CACHE_DIR'], exist_ok=True)
+    app.jinja_options = dict(app.jinja_options, 
+                             bytecode_cache=FileSystemBytecodeCache(app.config['TEMPLATE_BYTECODE_CACHE_DIR']))
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+replica_router.init_app(app)
 migrate = Migrate(app, db)
 login = LoginManager(app)
 mail = Mail(app)
 login.login_view = 'login'
+init_profiling(app)
+invalidation_bus = InvalidationBus(app.config['INVALIDATION_BUS_URL'], app.config['INVALIDATION_POLL_INTERVAL'])
+
+@app.before_request
+def poll_invalidation_bus():
+    invalidation_bus.poll()
 
 @app.context_processor
 def inject_template_scope():
@@ -26,35 +53,5 @@ def inject_template_scope():
     injections.update(cookies_check=cookies_check)
     return injections
 
-if not app.debug:
-
-    # SEND EMAIL IN CASE OF ERROR
-    if app.config['MAIL_SERVER']:
-        auth = None 
-        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-            auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-            secure=None
-            if app.config['MAIL_USE_TLS']:
-                secure = ()
-            mail_handler = SMTPHandler(mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-                                       fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-                                       toaddrs=app.config['ADMINS'], 
-                                       subject='Polyglotpivot Failure',
-                                       credentials=auth, secure=secure)
-            mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
-
-    # LOG TO FILE IN CASE OF ERROR
-    if not os.path.exists('logs'):
-        os.mkdir('logs')
-    file_handler = RotatingFileHandler('logs/polyglotpivot.log', maxBytes=10240, backupCount=10)
-    file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
-    
-    app.logger.setLevel(logging.INFO)
-    app.logger.info('Polyglotpivot startup')
-
-    
-from app import routes, models, errors 
+from app import routes, api, models, errors, cache, cli, retention 
 
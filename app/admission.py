@@ -0,0 +1,220 @@
+"""
+This module contains the admission control of the polyglotpivot project. Every
+request belongs to a route class:
+
+    practice   the practice loop (practice, new_vocable and their API versions),
+               never limited
+    expensive  submitted login, registration and password reset forms (password
+               hashing, emails), practice packs and syncs, bulk deletes and deep
+               vocabulary pages
+    default    everything else, e.g. showing the login form
+
+A class may only run ADMISSION_<CLASS>_LIMIT requests at the same time. A request
+waits at most ADMISSION_<CLASS>_WAIT seconds for a free slot and is otherwise
+answered with 503 and Retry-After, so the worker is free again for the practice
+loop. In addition, every user (or IP address, if nobody is logged in) gets a token
+bucket for expensive requests: ADMISSION_USER_BURST requests at once and
+ADMISSION_USER_RATE requests per second afterwards. Exceeding it returns 429.
+Behind a reverse proxy (nginx), set TRUSTED_PROXIES to the number of proxies, so the
+address of the client is taken from X-Forwarded-For. Otherwise all anonymous users
+share the bucket of the proxy's address.
+
+Admission control is enabled with ADMISSION_CONTROL. The limits are per worker
+process and matter with threaded workers (GUNICORN_THREADS > 1).
+"""
+
+from __future__ import annotations
+
+import math
+import threading
+from collections import OrderedDict
+from time import monotonic, perf_counter
+from flask import current_app, g, request
+from flask_login import current_user
+
+PRACTICE, EXPENSIVE, DEFAULT = 'practice', 'expensive', 'default'
+
+ROUTE_CLASSES = {'practice': PRACTICE,
+                 'new_vocable': PRACTICE,
+                 'api_practice': PRACTICE,
+                 'api_new_vocable': PRACTICE,
+                 'login': EXPENSIVE,
+                 'register': EXPENSIVE,
+                 'reset_password_request': EXPENSIVE,
+                 'reset_password': EXPENSIVE,
+                 'delete_vocables': EXPENSIVE,
+                 'api_practice_pack': EXPENSIVE,
+                 'api_practice_sync': EXPENSIVE}
+
+# expensive only when the form is submitted
+FORM_ENDPOINTS = {'login', 'register', 'reset_password_request', 'reset_password'}
+
+
+def route_class() -> str|None:
+    '''
+    Returns the route class of the current request or None for static files.
+    '''
+    if request.endpoint in (None, 'static'):
+        return None
+    if request.endpoint in ('vocabulary', 'api_vocabulary') and \
+            request.args.get('page', 1, type=int) > current_app.config['ADMISSION_DEEP_PAGE']:
+        return EXPENSIVE
+    if request.endpoint in FORM_ENDPOINTS and request.method != 'POST':
+        return DEFAULT
+    return ROUTE_CLASSES.get(request.endpoint, DEFAULT)
+
+
+class ClassLimiter:
+    '''
+    Concurrency limit and metrics of one route class. A limit of 0 admits every request.
+    '''
+
+    def __init__(self, name: str, limit: int, wait: float) -> None:
+        self.name = name
+        self.limit = limit
+        self.wait = wait
+        self._semaphore = threading.BoundedSemaphore(limit) if limit else None
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.shed = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.latency_seconds = 0.0
+        self.max_latency_seconds = 0.0
+
+    def acquire(self) -> bool:
+        started = perf_counter()
+        if self._semaphore is not None and not self._semaphore.acquire(timeout=self.wait):
+            with self._lock:
+                self.shed += 1
+            return False
+        waited = perf_counter() - started
+        with self._lock:
+            self.admitted += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return True
+
+    def release(self, latency: float) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self.latency_seconds += latency
+            self.max_latency_seconds = max(self.max_latency_seconds, latency)
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def throttle(self) -> None:
+        with self._lock:
+            self.throttled += 1
+
+    def metrics(self) -> dict:
+        with self._lock:
+            completed = self.admitted - self.in_flight
+            return {'limit': self.limit,
+                    'admitted': self.admitted,
+                    'shed_503': self.shed,
+                    'throttled_429': self.throttled,
+                    'in_flight': self.in_flight,
+                    'max_in_flight': self.max_in_flight,
+                    'mean_wait_ms': round(1000 * self.wait_seconds / self.admitted, 2) if self.admitted else 0,
+                    'max_wait_ms': round(1000 * self.max_wait_seconds, 2),
+                    'mean_latency_ms': round(1000 * self.latency_seconds / completed, 2) if completed else 0,
+                    'max_latency_ms': round(1000 * self.max_latency_seconds, 2)}
+
+
+class TokenBuckets:
+    '''
+    One token bucket per key with burst tokens, refilled with rate tokens per second.
+    At most maxsize keys are kept; the least recently used bucket is dropped (as full).
+    '''
+
+    def __init__(self, rate: float, burst: int, maxsize: int = 100000) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str) -> float:
+        '''
+        Takes a token of the bucket of key. Returns 0 on success, otherwise the number
+        of seconds until the next token is available.
+        '''
+        now = monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                retry_after = 0.0
+            else:
+                retry_after = (1 - tokens) / self.rate if self.rate else math.inf
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+
+class AdmissionController:
+    '''
+    Admits or rejects requests before the views run and keeps the metrics per route class.
+    '''
+
+    def __init__(self) -> None:
+        self.classes: dict[str, ClassLimiter] = {}
+        self.buckets: TokenBuckets | None = None
+
+    def init_app(self, app) -> None:
+        self.configure(app.config)
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+
+    def configure(self, config) -> None:
+        '''
+        (Re)creates the limiters and token buckets from the config. Resets the metrics.
+        '''
+        self.classes = {PRACTICE: ClassLimiter(PRACTICE, 0, 0),
+                        EXPENSIVE: ClassLimiter(EXPENSIVE, config['ADMISSION_EXPENSIVE_LIMIT'],
+                                                config['ADMISSION_EXPENSIVE_WAIT']),
+                        DEFAULT: ClassLimiter(DEFAULT, config['ADMISSION_DEFAULT_LIMIT'],
+                                              config['ADMISSION_DEFAULT_WAIT'])}
+        self.buckets = TokenBuckets(config['ADMISSION_USER_RATE'], config['ADMISSION_USER_BURST'])
+
+    def reject(self, status: int, message: str, retry_after: float):
+        retry_after = max(1, math.ceil(min(retry_after, 3600)))
+        return {'error': message}, status, {'Retry-After': str(retry_after)}
+
+    def admit(self):
+        if not current_app.config['ADMISSION_CONTROL']:
+            return None
+        name = route_class()
+        if name is None:
+            return None
+        limiter = self.classes[name]
+        if name == EXPENSIVE and self.buckets is not None:
+            key = f'user:{current_user.id}' if current_user.is_authenticated else f'ip:{request.remote_addr}'
+            retry_after = self.buckets.take(key)
+            if retry_after:
+                limiter.throttle()
+                return self.reject(429, 'Too many requests, please slow down.', retry_after)
+        if not limiter.acquire():
+            return self.reject(503, 'The server is busy, please retry.', current_app.config['ADMISSION_RETRY_AFTER'])
+        g.admission = (limiter, perf_counter())
+        return None
+
+    def release(self, exception=None) -> None:
+        admission = g.pop('admission', None)
+        if admission is not None:
+            limiter, started = admission
+            limiter.release(perf_counter() - started)
+
+    def metrics(self) -> dict:
+        return {name: limiter.metrics() for name, limiter in self.classes.items()}
+
+
+admission_controller = AdmissionController()
@@ -0,0 +1,127 @@
+"""
+This module contains the JSON endpoints of the polyglotpivot project. Like their
+html equivalents they run their database work on an AsyncSession (app.async_db).
+"""
+
+import gzip
+import io
+import json
+import zlib
+from flask import request, make_response
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from flask_login import current_user, login_required
+from app import app
+from app.models import Vocable, language_registry
+from app.async_db import async_db, get_practice_session, get_user_language_ids, get_vocables_page
+from app.async_db import set_due_vocable, grade_answer, get_due_vocables, apply_synced_results
+from app.packs import PACK_VERSION, encode_pack, parse_results
+from app.replicas import read_only
+from app.stats import get_language_stats, get_daily_activity
+
+
+@app.route('/api/vocabulary', methods=['GET'])
+@read_only
+@login_required
+def api_vocabulary():
+    page = request.args.get('page', 1, type=int)
+    with async_db.view_session() as session:
+        language_ids = async_db.run(get_user_language_ids(session, current_user.id))
+        vocables, has_next = async_db.run(get_vocables_page(session, current_user.id, page, app.config['VOCABLES_PER_PAGE']))
+    languages = [language_registry.get(id) for id in language_ids]
+    return {'page': page, 
+            'has_next': has_next, 
+            'vocables': [vocable.to_dict(languages) for vocable in vocables]}
+
+@app.route('/api/stats', methods=['GET'])
+@read_only
+@login_required
+def api_stats():
+    days = min(max(request.args.get('days', app.config['STATS_DAYS'], type=int), 1), 366)
+    return {'languages': get_language_stats(current_user.id),
+            'activity': get_daily_activity(current_user.id, days)}
+
+@app.route('/api/new_vocable', methods=['GET'])
+@login_required
+def api_new_vocable():
+    with async_db.view_session() as session:
+        practice_session = async_db.run(get_practice_session(session, current_user.id))
+        if not practice_session.target_language_id:
+            return {'error': 'Configure the practice languages first.'}, 409
+        source_language = language_registry.get(practice_session.source_language_id)
+        target_language = language_registry.get(practice_session.target_language_id)
+        vocable = async_db.run(set_due_vocable(session, current_user, practice_session, source_language, target_language))
+    if vocable is None:
+        return {'error': 'To practice, you first have to add vocabulary.'}, 404
+    return {'vocable_id': vocable.id,
+            'source_language': source_language.iso,
+            'target_language': target_language.iso,
+            'prompt': getattr(vocable, source_language.iso),
+            'level': getattr(vocable, target_language.iso + '_lvl')}
+
+@app.route('/api/practice', methods=['POST'])
+@login_required
+def api_practice():
+    answer = (request.get_json(silent=True) or {}).get('answer')
+    if not isinstance(answer, str):
+        return {'error': 'The request needs a JSON body with an answer.'}, 400
+    with async_db.view_session() as session:
+        practice_session = async_db.run(get_practice_session(session, current_user.id))
+        if not practice_session.vocable_id:
+            return {'error': 'Request a new vocable first.'}, 409
+        vocable = async_db.run(session.get(Vocable, practice_session.vocable_id))
+        target_language = language_registry.get(practice_session.target_language_id)
+        correct = async_db.run(grade_answer(session, vocable, answer, target_language))
+    return {'vocable_id': vocable.id,
+            'correct': correct,
+            'answer': getattr(vocable, target_language.iso),
+            'level': getattr(vocable, target_language.iso + '_lvl')}
+
+@app.route('/api/practice_pack', methods=['GET'])
+@read_only
+@login_required
+def api_practice_pack():
+    size = min(max(request.args.get('size', app.config['PRACTICE_PACK_SIZE'], type=int), 1), 
+               app.config['PRACTICE_PACK_MAX_SIZE'])
+    with async_db.view_session() as session:
+        practice_session = async_db.run(get_practice_session(session, current_user.id))
+        source_language = language_registry.by_iso(request.args.get('source', '')) or \
+            language_registry.get(practice_session.source_language_id)
+        target_language = language_registry.by_iso(request.args.get('target', '')) or \
+            language_registry.get(practice_session.target_language_id)
+        if source_language is None or target_language is None:
+            return {'error': 'Configure the practice languages first or pass source and target.'}, 409
+        vocables = async_db.run(get_due_vocables(session, current_user, source_language, target_language, size))
+    pack, checksum = encode_pack(vocables, source_language, target_language)
+    response = make_response(pack)
+    response.headers.update({'Content-Type': 'application/json',
+                             'Content-Encoding': 'gzip',
+                             'X-Pack-Version': str(PACK_VERSION),
+                             'X-Pack-SHA256': checksum})
+    return response
+
+@app.route('/api/practice_sync', methods=['POST'])
+@login_required
+def api_practice_sync():
+    max_results = app.config['PRACTICE_SYNC_MAX_RESULTS']
+    try:
+        body = request.get_data()
+        if request.headers.get('Content-Encoding') == 'gzip':
+            # at most 1 kB per result, so a small upload cannot expand without limit
+            body = gzip.GzipFile(fileobj=io.BytesIO(body)).read(1024 * max_results)
+        batch = json.loads(body)
+        target = batch.get('target')
+        target_language = language_registry.by_iso(target) if isinstance(target, str) else None
+        if target_language is None:
+            raise ValueError('The batch needs the iso code of its target language.')
+        results = parse_results(batch, max_results)
+    except (OSError, EOFError, zlib.error, ValueError, AttributeError) as error:
+        return {'error': str(error) or 'The batch is not valid JSON.'}, 400
+    try:
+        with async_db.view_session() as session:
+            applied = async_db.run(apply_synced_results(session, current_user.id, target_language, results))
+    except (IntegrityError, StaleDataError):
+        # a concurrent upload or answer changed the same rows, the batch can be sent again
+        return {'error': 'The batch conflicted with a concurrent change, please retry.'}, 409
+    return applied
+
@@ -0,0 +1,195 @@
+"""
+This module contains the asynchronous database access of the polyglotpivot project.
+The hot practice endpoints use an AsyncSession with an async driver (aiomysql or
+aiosqlite) instead of the sync flask-sqlalchemy session.
+
+Every worker process runs one event loop in a background thread, which all request
+threads share together with one pooled async engine. The views stay sync: only the
+coroutines of the AsyncSession run on the loop (async_db.run), while forms, the
+language_registry, the sync db.session and the templates stay in the request thread.
+So a sync round trip of one request never blocks the loop for the others. With
+threaded workers (GUNICORN_THREADS > 1), the database round trips of the threads
+wait on the loop instead of holding a connection of their own.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from app import app
+from app.models import Vocable, Session, LanguageRecord, user_language
+from app.packs import Result, apply_results
+from app.profiling import profile_coroutine
+from app.replicas import AsyncRoutingSession
+
+# sync driver of SQLALCHEMY_DATABASE_URI -> async driver
+ASYNC_DRIVERS = {'mysql': 'mysql+aiomysql',
+                 'mysql+pymysql': 'mysql+aiomysql',
+                 'sqlite': 'sqlite+aiosqlite',
+                 'sqlite+pysqlite': 'sqlite+aiosqlite'}
+
+
+def async_database_uri(uri: str) -> str:
+    '''
+    Returns the uri of the database with the corresponding async driver,
+    e.g. mysql+pymysql://... becomes mysql+aiomysql://...
+    '''
+    url = sa.make_url(uri)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername)).render_as_string(hide_password=False)
+
+
+class AsyncDatabase:
+    '''
+    Owns the event loop of the worker process and lazily creates the pooled async
+    engine from the app config. The connections of a pool and the asyncio locks of an
+    engine belong to the loop they were created in, so all coroutines of the worker
+    run on this one loop. A forked process starts its own loop and engine.
+    '''
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pid: int | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._engine: AsyncEngine | None = None
+        self._sessionmaker: async_sessionmaker[AsyncSession] | None = None
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._pid != os.getpid():
+                # the loop thread and the pooled connections of the parent are not usable after a fork
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name='async-db', daemon=True)
+                self._thread.start()
+                self._engine = None
+                self._sessionmaker = None
+                self._pid = os.getpid()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._pid != os.getpid():
+            self._start()
+        return self._loop  # type: ignore[return-value]
+
+    @property
+    def engine(self) -> AsyncEngine:
+        if self._pid != os.getpid():
+            self._start()
+        with self._lock:
+            if self._engine is None:
+                uri = app.config['ASYNC_DATABASE_URI'] or async_database_uri(app.config['SQLALCHEMY_DATABASE_URI'])
+                self._engine = create_async_engine(uri, pool_size=app.config['ASYNC_POOL_SIZE'], pool_pre_ping=True)
+            return self._engine
+
+    def session(self) -> AsyncSession:
+        engine = self.engine
+        with self._lock:
+            if self._sessionmaker is None:
+                self._sessionmaker = async_sessionmaker(engine, expire_on_commit=False, 
+                                                        sync_session_class=AsyncRoutingSession)
+            return self._sessionmaker()
+
+    @contextmanager
+    def view_session(self) -> Iterator[AsyncSession]:
+        '''
+        Returns an AsyncSession for a sync view. Its coroutines are awaited with run(),
+        the session is closed when the with block is left.
+        '''
+        session = self.session()
+        try:
+            yield session
+        finally:
+            self.run(session.close())
+
+    def run(self, coroutine):
+        '''
+        Runs the coroutine on the event loop of the worker and returns its result. The
+        coroutine sees the context variables of the calling thread, e.g. the request
+        context of flask.
+        '''
+        if threading.current_thread() is self._thread:
+            raise RuntimeError('A coroutine cannot wait for the event loop it runs on.')
+        return asyncio.run_coroutine_threadsafe(profile_coroutine(coroutine), self.loop).result()
+
+
+async_db = AsyncDatabase()
+
+
+async def get_practice_session(session: AsyncSession, user_id: int) -> Session | None:
+    '''
+    Returns the practice session (source language, target language and vocable) of a user.
+    '''
+    return await session.get(Session, user_id)
+
+
+async def get_user_language_ids(session: AsyncSession, user_id: int) -> list[int]:
+    '''
+    Returns the language ids of a user. They are resolved with the language_registry
+    in the request thread, which may have to load the language table.
+    '''
+    query = sa.select(user_language.c.language_id).where(user_language.c.user_id == user_id)
+    return list((await session.scalars(query)).all())
+
+
+async def get_vocables_page(session: AsyncSession, user_id: int, page: int, per_page: int) -> tuple[list[Vocable], bool]:
+    '''
+    Returns the vocables of a page of the vocabulary listing and whether there is a next page.
+    '''
+    vocables = (await session.scalars(get_query_of_vocables_page(user_id, page, per_page))).all()
+    return list(vocables[:per_page]), len(vocables) > per_page
+
+
+def get_query_of_vocables_page(user_id: int, page: int, per_page: int) -> sa.Select:
+    '''
+    Returns the select statement of a page of the vocabulary listing with one extra
+    vocable, which tells whether there is a next page.
+    '''
+    return sa.select(Vocable).where(Vocable.user_id == user_id).order_by(Vocable.id)\
+        .offset((page - 1) * per_page).limit(per_page + 1)
+
+
+async def set_due_vocable(session: AsyncSession, user, practice_session: Session, 
+                          source_language: LanguageRecord, target_language: LanguageRecord) -> Vocable | None:
+    '''
+    Selects the vocable that was not practiced for the longest time in the language pair of the
+    practice session, stores it in the practice session and commits.
+    '''
+    query = user.get_query_of_vocables_with_latest_timestamp(source_language, target_language).limit(1)
+    row = (await session.execute(query)).first()
+    practice_session.vocable_id = row[0].id if row else None
+    await session.commit()
+    return row[0] if row else None
+
+
+async def get_due_vocables(session: AsyncSession, user, source_language: LanguageRecord, 
+                           target_language: LanguageRecord, number: int) -> list[Vocable]:
+    '''
+    Returns the number vocables that were not practiced for the longest time in the language pair.
+    '''
+    query = user.get_query_of_vocables_with_latest_timestamp(source_language, target_language).limit(number)
+    return [row[0] for row in (await session.execute(query)).all()]
+
+
+async def grade_answer(session: AsyncSession, vocable: Vocable, answer: str, target_language: LanguageRecord) -> bool:
+    '''
+    Grades the answer, sets the new level of the vocable, adds the Practice entry, updates the
+    learning statistics and commits.
+    '''
+    answer_correct = await session.run_sync(lambda sync_session: vocable.apply_answer(answer, target_language))
+    await session.commit()
+    return answer_correct
+
+
+async def apply_synced_results(session: AsyncSession, user_id: int, target_language: LanguageRecord, 
+                               results: list[Result]) -> dict:
+    '''
+    Applies the results of a synced practice pack with app.packs.apply_results and commits.
+    '''
+    applied = await session.run_sync(lambda sync_session: apply_results(sync_session, user_id, target_language, results))
+    await session.commit()
+    return applied
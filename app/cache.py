@@ -0,0 +1,92 @@
+"""
+This module contains the in-process caches of the polyglotpivot project. At the moment
+this is the fragment cache for the rows of the vocabulary page. Entries are tagged with
+the user they belong to and are dropped when the invalidation_bus publishes 'user:<id>'.
+"""
+
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable
+from flask import get_template_attribute
+from markupsafe import Markup
+from app import app, invalidation_bus
+import threading
+
+
+class FragmentCache:
+    '''
+    Thread safe least recently used cache for rendered template fragments. 
+    If more than maxsize entries are stored, the least recently used entry is dropped.
+    Entries can be tagged and dropped in bulk by tag.
+    '''
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self._entry_tags: dict[Hashable, tuple[str, ...]] = {}
+        self._tagged: dict[str, set[Hashable]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, tags: Iterable[str] = ()) -> None:
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = value
+            self._entry_tags[key] = tuple(tags)
+            for tag in self._entry_tags[key]:
+                self._tagged.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+        for tag in self._entry_tags.pop(key, ()):
+            self._tagged[tag].discard(key)
+            if not self._tagged[tag]:
+                del self._tagged[tag]
+
+    def invalidate_tag(self, tag: str) -> None:
+        '''
+        Drops all entries with the given tag.
+        '''
+        with self._lock:
+            for key in list(self._tagged.get(tag, ())):
+                self._drop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._entry_tags.clear()
+            self._tagged.clear()
+
+
+fragment_cache = FragmentCache(app.config['FRAGMENT_CACHE_SIZE'])
+
+@invalidation_bus.subscribe_to('user:')
+def invalidate_user_fragments(key: str|None, generation: int) -> None:
+    if key is None:
+        fragment_cache.clear()
+    else:
+        fragment_cache.invalidate_tag(key)
+
+@app.template_global()
+def render_vocable_row(vocable, languages) -> Markup:
+    '''
+    Renders one row of the vocabulary table with the vocable_row macro. The html 
+    is cached per vocable id, vocable version and language set. The version is 
+    raised by every update of the vocable, so outdated rows are never served.
+    '''
+    key = (vocable.id, vocable.version_id, tuple(l.iso for l in languages))
+    row = fragment_cache.get(key)
+    if row is None:
+        row = get_template_attribute('_vocable.html', 'vocable_row')(vocable, languages)
+        fragment_cache.set(key, row, tags=(f'user:{vocable.user_id}',))
+    return row
@@ -0,0 +1,82 @@
+"""
+This module contains the flask command line commands of the polyglotpivot project.
+"""
+
+import click
+import sqlalchemy as sa
+from app import app, db
+from app.models import User
+from app.retention import compact_practices_locked
+from app.stats import rebuild_stats, check_stats
+
+
+@app.cli.group()
+def account():
+    """User account commands."""
+    pass
+
+@account.command()
+@click.argument('username')
+@click.option('--batch-size', type=int, default=None, 
+              help='Number of rows deleted per transaction.')
+def purge(username, batch_size):
+    """Delete a user account with all its data in batches."""
+    user = db.session.scalar(sa.select(User).where(User.username == username))
+    if user is None:
+        raise click.ClickException(f'There is no user {username}.')
+    user.purge(batch_size or app.config['PURGE_BATCH_SIZE'])
+    click.echo(f'User {username} was purged.')
+
+@account.command()
+@click.argument('username')
+@click.option('--revoke', is_flag=True, help='Revoke the admin rights instead.')
+def admin(username, revoke):
+    """Grant a user admin rights (profiles, admission metrics)."""
+    user = db.session.scalar(sa.select(User).where(User.username == username))
+    if user is None:
+        raise click.ClickException(f'There is no user {username}.')
+    user.is_admin = not revoke
+    db.session.commit()
+    click.echo(f'User {username} is {"no longer " if revoke else ""}an admin.')
+
+@app.cli.group()
+def practice():
+    """Practice log commands."""
+    pass
+
+@practice.command()
+@click.option('--horizon-days', type=int, default=None,
+              help='Compact practices older than this number of days.')
+@click.option('--batch-size', type=int, default=None,
+              help='Number of practices compacted per transaction.')
+@click.option('--archive-dir', default=None, 
+              help='Directory of the NDJSON archive files.')
+def compact(horizon_days, batch_size, archive_dir):
+    """Archive old practices and fold them into daily aggregates."""
+    compacted = compact_practices_locked(horizon_days, batch_size, archive_dir)
+    if compacted is None:
+        raise click.ClickException('Another process is compacting the practice log, try again later.')
+    click.echo(f'{compacted} practices were compacted.')
+
+@app.cli.group()
+def stats():
+    """Learning statistics commands."""
+    pass
+
+@stats.command()
+@click.option('--batch-size', type=int, default=None, help='Number of practices read per query.')
+def rebuild(batch_size):
+    """Rebuild the learning statistics from the practice log."""
+    rebuild_stats(batch_size or app.config['STATS_REBUILD_BATCH_SIZE'])
+    click.echo('Learning statistics were rebuilt.')
+
+@stats.command()
+@click.option('--batch-size', type=int, default=None, help='Number of practices read per query.')
+def check(batch_size):
+    """Compare the learning statistics with the practice log."""
+    differences = check_stats(batch_size or app.config['STATS_REBUILD_BATCH_SIZE'])
+    for difference in differences:
+        click.echo(difference)
+    if differences:
+        raise click.ClickException(f'{len(differences)} differences found.')
+    click.echo('Learning statistics are consistent.')
@@ -0,0 +1,227 @@
+"""
+This module contains the cache invalidation bus of the polyglotpivot project. Every
+gunicorn worker has its own in-process caches. When one worker changes data, it
+publishes a key (e.g. 'user:5'), which raises the generation of the key. The other
+workers poll the bus before each request (at most every INVALIDATION_POLL_INTERVAL
+seconds) and call the subscribers of the key, which drop their cached entries.
+
+The backend is chosen by the scheme of INVALIDATION_BUS_URL:
+
+    sqlite:///path/to/bus.db   all workers on one machine (default)
+    redis://host:6379/0        workers on several machines (needs the redis package)
+
+Further backends can be added with register_backend.
+"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+from time import monotonic
+from typing import Callable, Protocol
+from urllib.parse import urlsplit
+
+# subscriber callbacks get the key and its generation. After missed events the key
+# is None and the subscriber has to drop everything it cached.
+Subscriber = Callable[[str | None, int], None]
+
+
+class Backend(Protocol):
+    def publish(self, key: str) -> int: ...
+    def generation(self, key: str) -> int: ...
+    def latest_cursor(self): ...
+    def events_since(self, cursor) -> tuple[list[tuple], bool]: ...
+
+
+class SQLiteBackend:
+    '''
+    Keeps the generations and a log of the latest events in a SQLite file, which is
+    shared by all processes on the machine. Every process opens its own connection.
+    '''
+
+    def __init__(self, path: str, keep_events: int = 10000) -> None:
+        self.path = path
+        self.keep_events = keep_events
+        self._lock = threading.Lock()
+        self._pid: int | None = None
+        self._connection: sqlite3.Connection | None = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS generations '
+                                     '(key TEXT PRIMARY KEY, generation INTEGER NOT NULL)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS events '
+                                     '(seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, generation INTEGER NOT NULL)')
+            self._pid = os.getpid()
+        return self._connection  # type: ignore[return-value]
+
+    def publish(self, key: str) -> int:
+        with self._lock:
+            connection = self.connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute('INSERT INTO generations (key, generation) VALUES (?, 1) '
+                                   'ON CONFLICT (key) DO UPDATE SET generation = generation + 1', (key,))
+                generation = connection.execute('SELECT generation FROM generations WHERE key = ?', (key,)).fetchone()[0]
+                seq = connection.execute('INSERT INTO events (key, generation) VALUES (?, ?)', (key, generation)).lastrowid
+                if seq % 1000 == 0:
+                    connection.execute('DELETE FROM events WHERE seq <= ?', (seq - max(self.keep_events, 1),))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        return generation
+
+    def generation(self, key: str) -> int:
+        with self._lock:
+            row = self.connection.execute('SELECT generation FROM generations WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def latest_cursor(self) -> int:
+        with self._lock:
+            return self.connection.execute('SELECT coalesce(max(seq), 0) FROM events').fetchone()[0]
+
+    def events_since(self, cursor: int) -> tuple[list[tuple], bool]:
+        '''
+        Returns the events (seq, key, generation) after the cursor and whether events
+        were missed because they were already deleted.
+        '''
+        with self._lock:
+            events = self.connection.execute('SELECT seq, key, generation FROM events WHERE seq > ? ORDER BY seq',
+                                             (cursor,)).fetchall()
+        return events, bool(events) and events[0][0] > cursor + 1
+
+
+class RedisBackend:
+    '''
+    Keeps the generations in a redis hash and the events in a capped redis stream.
+    '''
+
+    def __init__(self, url: str, name: str = 'polyglotpivot:invalidation', keep_events: int = 10000) -> None:
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis invalidation backend needs the redis package.')
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self.generations = name + ':generations'
+        self.stream = name + ':events'
+        self.keep_events = keep_events
+
+    def publish(self, key: str) -> int:
+        generation = self._redis.hincrby(self.generations, key, 1)
+        self._redis.xadd(self.stream, {'key': key, 'generation': generation},
+                         maxlen=self.keep_events, approximate=True)
+        return generation
+
+    def generation(self, key: str) -> int:
+        return int(self._redis.hget(self.generations, key) or 0)
+
+    def latest_cursor(self) -> str:
+        events = self._redis.xrevrange(self.stream, count=1)
+        return events[0][0] if events else '0-0'
+
+    def events_since(self, cursor: str) -> tuple[list[tuple], bool]:
+        '''
+        Returns the events (id, key, generation) after the cursor and whether events
+        were missed because the stream was trimmed past the cursor.
+        '''
+        events = self._redis.xrange(self.stream, min='(' + cursor)
+        missed = False
+        if events and cursor != '0-0':
+            first = self._redis.xinfo_stream(self.stream)['first-entry']
+            missed = first is not None and stream_id(first[0]) > stream_id(cursor) and \
+                self._redis.xrange(self.stream, min=cursor, max=cursor) == []
+        return [(id, fields['key'], int(fields['generation'])) for id, fields in events], missed
+
+
+def stream_id(id: str) -> tuple[int, int]:
+    '''
+    Returns the id of a redis stream entry ('<milliseconds>-<sequence>') as comparable tuple.
+    '''
+    milliseconds, _, sequence = id.partition('-')
+    return int(milliseconds), int(sequence or 0)
+
+
+BACKENDS: dict[str, Callable[[str], Backend]] = {
+    'sqlite': lambda url: SQLiteBackend(urlsplit(url).path[1:]),
+    'redis': RedisBackend,
+    'rediss': RedisBackend,
+}
+
+def register_backend(scheme: str, factory: Callable[[str], Backend]) -> None:
+    '''
+    Makes a backend available for INVALIDATION_BUS_URLs with the given scheme.
+    '''
+    BACKENDS[scheme] = factory
+
+
+class InvalidationBus:
+    '''
+    Publishes invalidated keys and dispatches the keys published by other processes
+    to the subscribers of this process.
+    '''
+
+    def __init__(self, url: str, poll_interval: float = 0) -> None:
+        self.backend = BACKENDS[urlsplit(url).scheme](url)
+        self.poll_interval = poll_interval
+        self._subscribers: list[tuple[str, Subscriber]] = []
+        self._lock = threading.Lock()
+        self._cursor = None
+        self._polled_at = float('-inf')
+
+    def subscribe(self, prefix: str, subscriber: Subscriber) -> None:
+        '''
+        Calls subscriber for every published key that starts with prefix.
+        '''
+        self._subscribers.append((prefix, subscriber))
+
+    def subscribe_to(self, prefix: str) -> Callable[[Subscriber], Subscriber]:
+        '''
+        Decorator version of subscribe.
+        '''
+        def decorator(subscriber: Subscriber) -> Subscriber:
+            self.subscribe(prefix, subscriber)
+            return subscriber
+        return decorator
+
+    def _dispatch(self, key: str | None, generation: int) -> None:
+        for prefix, subscriber in self._subscribers:
+            if key is None or key.startswith(prefix):
+                subscriber(key, generation)
+
+    def publish(self, key: str) -> int:
+        '''
+        Raises the generation of the key and invalidates it in all processes. The
+        subscribers of this process are called immediately.
+        '''
+        generation = self.backend.publish(key)
+        self._dispatch(key, generation)
+        return generation
+
+    def generation(self, key: str) -> int:
+        return self.backend.generation(key)
+
+    def poll(self, force: bool = False) -> int:
+        '''
+        Dispatches the keys published since the last poll. Returns the number of events.
+        Without force, the backend is asked at most every poll_interval seconds.
+        '''
+        if not force and monotonic() - self._polled_at < self.poll_interval:
+            return 0
+        with self._lock:
+            self._polled_at = monotonic()
+            if self._cursor is None:
+                # caches of a new process are empty, older events do not matter
+                self._cursor = self.backend.latest_cursor()
+                return 0
+            events, missed = self.backend.events_since(self._cursor)
+            if missed:
+                self._dispatch(None, 0)
+            for cursor, key, generation in events:
+                self._dispatch(key, generation)
+                self._cursor = cursor
+            return len(events)
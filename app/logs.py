@@ -0,0 +1,211 @@
+"""
+This module contains the logging of the polyglotpivot project. Request threads only
+put log records into a bounded queue. A QueueListener thread writes them as JSON
+lines to a rotating file and sends error emails, at most one every LOG_MAIL_INTERVAL
+seconds. If the queue is full, records are dropped and counted instead of blocking
+the request.
+
+Every request is logged with its request id, route, status, latency and number of
+SQL statements.
+"""
+
+from __future__ import annotations
+
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import threading
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, SMTPHandler
+from time import monotonic, perf_counter
+import sqlalchemy as sa
+from flask import current_app, g, has_request_context, request
+
+# attributes of a log record that are written as fields of the JSON line
+REQUEST_FIELDS = ('request_id', 'method', 'route', 'status', 'latency_ms', 'sql_count', 'user_id')
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats a log record as one JSON line.
+    '''
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage(),
+                'where': f'{record.pathname}:{record.lineno}'}
+        line.update({field: getattr(record, field) for field in REQUEST_FIELDS if getattr(record, field, None) is not None})
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            line['exception'] = record.exc_text
+        return json.dumps(line, default=str)
+
+
+class RequestIdFilter(logging.Filter):
+    '''
+    Adds the id of the current request to every record that is logged inside a request.
+    '''
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, 'request_id', None) is None and has_request_context():
+            record.request_id = g.get('request_id')
+        return True
+
+
+class BoundedQueueHandler(QueueHandler):
+    '''
+    Puts records into a queue of maxsize records and hands them to a QueueListener
+    with the given handlers. Records that do not fit into the queue are dropped and
+    counted. The listener is started in every process that logs, so the handler also
+    works in workers forked after the app was imported.
+    '''
+
+    def __init__(self, maxsize: int, *handlers: logging.Handler) -> None:
+        super().__init__(queue.Queue(maxsize))
+        self.maxsize = maxsize
+        self.handlers = handlers
+        self.dropped = 0
+        self._reported = 0
+        self._pid: int | None = None
+        self._listener: QueueListener | None = None
+        self._start_lock = threading.Lock()
+        self.addFilter(RequestIdFilter())
+        atexit.register(self.stop)
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._pid != os.getpid():
+                # the queue and the listener thread of the parent are not usable after a fork
+                self.queue = queue.Queue(self.maxsize)
+                self._listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+                self._listener.start()
+                self._pid = os.getpid()
+
+    def stop(self) -> None:
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # unlike QueueHandler.prepare, the traceback stays separate from the message
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self._pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self._reported < self.dropped:
+            dropped, self._reported = self.dropped - self._reported, self.dropped
+            warning = logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                                        '%d log records were dropped, the log queue was full.', (dropped,), None)
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                self._reported -= dropped
+
+
+class RateLimitedSMTPHandler(SMTPHandler):
+    '''
+    Sends at most one email every interval seconds. The subject of the next email
+    contains the number of suppressed records.
+    '''
+
+    def __init__(self, *args, interval: float, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.interval = interval
+        self.suppressed = 0
+        self._next_email = float('-inf')
+
+    def emit(self, record: logging.LogRecord) -> None:
+        now = monotonic()
+        if now < self._next_email:
+            self.suppressed += 1
+            return
+        self._next_email = now + self.interval
+        super().emit(record)
+        self.suppressed = 0
+
+    def getSubject(self, record: logging.LogRecord) -> str:
+        if self.suppressed:
+            return f'{self.subject} ({self.suppressed} more errors since the last email)'
+        return self.subject
+
+
+def count_statement(conn, cursor, statement, parameters, context, executemany) -> None:
+    if has_request_context():
+        g.sql_count = g.get('sql_count', 0) + 1
+
+
+def start_request() -> None:
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.request_started = perf_counter()
+    g.sql_count = 0
+
+
+def log_request(response):
+    current_app.logger.info('%s %s %s', request.method, request.path, response.status_code, extra={
+        'method': request.method,
+        'route': request.url_rule.rule if request.url_rule else None,
+        'status': response.status_code,
+        'latency_ms': round((perf_counter() - g.get('request_started', perf_counter())) * 1000, 2),
+        'sql_count': g.get('sql_count', 0),
+        'user_id': getattr(g.get('_login_user'), 'id', None)})  # only if flask-login loaded the user
+    response.headers['X-Request-ID'] = g.get('request_id', '')
+    return response
+
+
+def init_logging(app) -> BoundedQueueHandler:
+    '''
+    Sends the log records of the app through a BoundedQueueHandler to the log file and,
+    if a mail server is configured, errors to the ADMINS. Logs every request.
+    '''
+    handlers: list[logging.Handler] = []
+    if app.config['MAIL_SERVER']:
+        auth, secure = None, None
+        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+            auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+            if app.config['MAIL_USE_TLS']:
+                secure = ()
+        mail_handler = RateLimitedSMTPHandler(mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+                                              fromaddr='no-reply@' + app.config['MAIL_SERVER'],
+                                              toaddrs=app.config['ADMINS'],
+                                              subject='Polyglotpivot Failure',
+                                              credentials=auth, secure=secure,
+                                              interval=app.config['LOG_MAIL_INTERVAL'])
+        mail_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+        mail_handler.setLevel(logging.ERROR)
+        handlers.append(mail_handler)
+
+    os.makedirs(app.config['LOG_DIR'], exist_ok=True)
+    file_handler = RotatingFileHandler(os.path.join(app.config['LOG_DIR'], 'polyglotpivot.log'),
+                                       maxBytes=app.config['LOG_MAX_BYTES'], backupCount=app.config['LOG_BACKUP_COUNT'])
+    file_handler.setFormatter(JsonFormatter())
+    file_handler.setLevel(logging.INFO)
+    handlers.append(file_handler)
+
+    queue_handler = BoundedQueueHandler(app.config['LOG_QUEUE_SIZE'], *handlers)
+    app.logger.addHandler(queue_handler)
+    app.logger.setLevel(logging.INFO)
+
+    sa.event.listen(sa.Engine, 'before_cursor_execute', count_statement)
+    app.before_request(start_request)
+    app.after_request(log_request)
+    return queue_handler
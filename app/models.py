@@ -5,17 +5,33 @@ polyglotpivot project.
 
 from __future__ import annotations
 
-from datetime import datetime, timezone
+from datetime import datetime, timezone, date, timedelta
 from werkzeug.security import check_password_hash, generate_password_hash
-from typing import Optional 
+from typing import Optional, NamedTuple, Iterable
+from types import MappingProxyType
+import threading
 import sqlalchemy as sa 
 import sqlalchemy.orm as so
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from flask_login import UserMixin
-from app import db, login, app
+from app import db, login, app, invalidation_bus
+from app.replicas import read_only
 from hashlib import md5
 from sqlalchemy.sql.expression import func 
 from time import time
 import jwt
+import sqlite3
+
+@sa.event.listens_for(sa.Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record) -> None:
+    '''
+    SQLite ignores foreign keys (and ON DELETE CASCADE) unless they are enabled
+    for every connection.
+    '''
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
 
 @login.user_loader 
 def load_user(id: int|str) -> User|None:
@@ -29,8 +45,8 @@ def load_user(id: int|str) -> User|None:
 
 user_language = sa.Table('user_language', 
                      db.metadata, 
-                     sa.Column('user_id', sa.ForeignKey('user.id'), primary_key=True),
-                     sa.Column('language_id', sa.ForeignKey('language.id'), primary_key=True))
+                     sa.Column('user_id', sa.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True),
+                     sa.Column('language_id', sa.ForeignKey('language.id', ondelete='CASCADE'), primary_key=True))
 
 
 class User(UserMixin, db.Model): # type: ignore
@@ -42,18 +58,68 @@ class User(UserMixin, db.Model): # type: ignore
     password_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(256))
     about_me: so.Mapped[Optional[str]] = so.mapped_column(sa.String(140))
     last_seen: so.Mapped[Optional[datetime]] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
+    # only granted with flask account admin, the email of an account is not verified
+    is_admin: so.Mapped[bool] = so.mapped_column(default=False, server_default=sa.false())
 
     languages: so.Mapped[list['Language']]= so.relationship(
         secondary=user_language, 
         back_populates='users')
     
-    vocables: so.Mapped[list['Vocable']]=so.relationship(back_populates='user')
-    posts: so.Mapped[list['Post']]=so.relationship(back_populates='author')
-    session: so.Mapped['Session'] = so.relationship(back_populates='user')
+    # the rows of a user are deleted by the ON DELETE CASCADE foreign keys of the database
+    vocables: so.Mapped[list['Vocable']]=so.relationship(back_populates='user', cascade="all, delete", passive_deletes=True)
+    posts: so.Mapped[list['Post']]=so.relationship(back_populates='author', cascade="all, delete", passive_deletes=True)
+    session: so.Mapped['Session'] = so.relationship(back_populates='user', cascade="all, delete", passive_deletes=True)
     
     def __repr__(self) -> str:
         return f'<User {self.username}>'
     
+    def delete_vocables(self: User, vocable_ids: list[int|str]) -> int:
+        '''
+        Deletes the vocables with the given ids with one DELETE statement. Only vocables
+        of the User are deleted, ids of other users are ignored. The practices of the 
+        vocables are deleted by the database (ON DELETE CASCADE). Returns the number of 
+        deleted vocables.
+        '''
+        ids = [int(id) for id in vocable_ids]
+        if not ids:
+            return 0
+        result = db.session.execute(sa.delete(Vocable).where(Vocable.user_id == self.id, Vocable.id.in_(ids)),
+                                    execution_options={'synchronize_session': 'fetch'})
+        db.session.commit()
+        self.invalidate_caches()
+        return result.rowcount
+
+    def invalidate_caches(self: User) -> None:
+        '''
+        Drops the cached fragments of the User in all worker processes. Has to be called
+        after changes of his vocables or languages were committed.
+        '''
+        invalidation_bus.publish(f'user:{self.id}')
+
+    def purge(self: User, batch_size: int = 1000) -> None:
+        '''
+        Deletes the User with all his data. The practices, vocables and posts are deleted 
+        in batches of batch_size rows with a commit after every batch, so no statement 
+        holds locks on a large part of a table.
+        '''
+        user_id = self.id
+        user_vocables = sa.select(Vocable.id).where(Vocable.user_id == user_id)
+        batches = [(Practice, sa.select(Practice.id).where(Practice.vocable_id.in_(user_vocables))),
+                   (PracticeDay, sa.select(PracticeDay.id).where(PracticeDay.user_id == user_id)),
+                   (LearningDay, sa.select(LearningDay.id).where(LearningDay.user_id == user_id)),
+                   (LanguageStats, sa.select(LanguageStats.id).where(LanguageStats.user_id == user_id)),
+                   (Vocable, user_vocables),
+                   (Post, sa.select(Post.id).where(Post.user_id == user_id))]
+        for model, query in batches:
+            while ids := db.session.scalars(query.limit(batch_size)).all():
+                db.session.execute(sa.delete(model).where(model.id.in_(ids)),
+                                   execution_options={'synchronize_session': False})
+                db.session.commit()
+        db.session.execute(sa.delete(User).where(User.id == user_id), 
+                           execution_options={'synchronize_session': False})
+        db.session.commit()
+        invalidation_bus.publish(f'user:{user_id}')
+
     def get_number_vocables(self):
         db.session.query(User).join(db.session.query(Vocable.user_id,sa.func.count(Vocable.user_id).label('number_vocables')).group_by(Vocable.user_id).subquery(),User.id == Vocable.user_id, isouter=True).all()
     def set_password(self:User, password:str) -> None:
@@ -69,16 +135,13 @@ class User(UserMixin, db.Model): # type: ignore
         '''
         return check_password_hash(self.password_hash, password)
     
+    @read_only
     def get_number_of_words_per_level(self:User, language:Language) -> list[tuple[int, int]]:
         '''
         Gets the number Vocable instances at every level (from 0 to Vocable.MAX_LVL) of the
         defined language.
         '''
-        target_lvl = language.iso + "_lvl"
-        result = db.session.query(
-            getattr(Vocable, target_lvl), sa.func.count(getattr(Vocable, target_lvl))) \
-            .select_from(Vocable).group_by(getattr(Vocable, target_lvl))\
-            .where(Vocable.user_id == self.id).all()
+        result = db.session.execute(self.get_query_of_words_per_level(language)).all()
         
         # fill empty level tuples
         present_levels = [i[0] for i in result]
@@ -89,67 +152,95 @@ class User(UserMixin, db.Model): # type: ignore
            
         return result
 
+    def get_query_of_words_per_level(self: User, language:Language) -> sa.Select:
+        '''
+        Returns the select statement of get_number_of_words_per_level.
+        '''
+        target_lvl = getattr(Vocable, language.iso + "_lvl")
+        return sa.select(target_lvl, sa.func.count(target_lvl)).where(Vocable.user_id == self.id).group_by(target_lvl)
     
     def set_languages(self: User, languages:list[str]) -> None:
         '''
         Sets the languages a User has. The argument languages is a list of
         languages as string e.g ['English','German']. It is important that
-        that there is an entry in the Vocable table with the corresponding
-        Vocable.name
+        that there is an entry in the Language table with the corresponding
+        Language.name. The names are resolved with the language_registry, so
+        only the user_language association rows are written.
         '''
-        query = sa.select(Language).where(Language.name.in_(languages))
-        new_languages = db.session.scalars(query).all()
-        self.languages = new_languages
+        # a name that is given twice would violate the primary key of user_language
+        language_ids = list(dict.fromkeys(language_registry.by_name(name).id for name in languages 
+                                          if language_registry.by_name(name)))
+        db.session.execute(sa.delete(user_language).where(user_language.c.user_id == self.id))
+        if language_ids:
+            db.session.execute(sa.insert(user_language), 
+                               [{'user_id': self.id, 'language_id': id} for id in language_ids])
+        db.session.expire(self, ['languages'])
         db.session.commit()
 
+    def get_languages(self: User) -> list[LanguageRecord]:
+        '''
+        Returns the languages of the User from the language_registry. Unlike the
+        languages relationship, only the user_language association rows are read.
+        '''
+        query = sa.select(user_language.c.language_id).where(user_language.c.user_id == self.id)
+        return [language_registry.get(id) for id in db.session.scalars(query).all()]
+
     def get_random_vocable(self: User, source_language:Language, target_language:Language, level:int|None=None):
             '''
             Returns a random instance of class Vocable of a User. By setting the level argument one can 
             filter for the level. The level can be from 0 (new) to 6 (learned). It only returns vocable
             that are both defined in target and source language.
             '''
-            if level:
-                query = sa.select(Vocable).where(sa.and_(Vocable.user_id == self.id,
-                            getattr(Vocable, target_language.iso) != "",
-                            getattr(Vocable, source_language.iso) != "",
-                            getattr(Vocable, f"{target_language.iso}_lvl") == level)).order_by(func.random())
-            else: 
-                query = sa.select(Vocable).where(sa.and_(Vocable.user_id == self.id,
-                            getattr(Vocable,target_language.iso) != "",
-                            getattr(Vocable,source_language.iso) != "")).order_by(func.random())
-            return db.session.scalar(query)
+            return db.session.scalar(self.get_query_of_random_vocable(source_language, target_language, level))
+
+    def get_query_of_random_vocable(self: User, source_language:Language, target_language:Language, level:int|None=None) -> sa.Select:
+        '''
+        Returns the select statement of get_random_vocable.
+        '''
+        query = sa.select(Vocable).where(sa.and_(Vocable.user_id == self.id,
+                    getattr(Vocable, target_language.iso) != "",
+                    getattr(Vocable, source_language.iso) != ""))
+        if level:
+            query = query.where(getattr(Vocable, f"{target_language.iso}_lvl") == level)
+        return query.order_by(func.random())
 
     def get_due_vocable(self, source_language:Language, target_language:Language) -> Vocable:
         '''
         Returns the vocable that was not practiced for the longest time according
         to the database entry of the Practice table.
         '''
-        return self.get_query_of_vocables_with_latest_timestamp(source_language, target_language).first()
+        return db.session.execute(self.get_query_of_vocables_with_latest_timestamp(source_language, target_language)).first()
 
 
-    def get_query_of_vocables_with_latest_timestamp(self: User, source_language:Language, target_language:Language) -> sa.orm.Query.query:
+    def get_query_of_vocables_with_latest_timestamp(self: User, source_language:Language, target_language:Language) -> sa.Select:
         '''
-        Returns a query object which can be either used as further subquery or to get results.
-        For example using one(), all(), first(), etc. The query will give all entries in vocable for a 
+        Returns a select statement which can be either used as further subquery or executed with
+        a (sync or async) session. The query will give all entries in vocable for a 
         user. It will include the date when the vocable was studied for the last time with the given
         language.
         '''
-        # Filter the practice table for the language
-        subsubquery = sa.Select(Practice).filter(Practice.language_id == target_language.id).subquery()
-
-        # Get the practice entries with the latest timestamp for each vocable
-        subquery = sa.select(subsubquery.c.vocable_id, sa.func.max(subsubquery.c.timestamp).label("latest_timestamp")).group_by(subsubquery.c.vocable_id).subquery()
-        
-        # join vocable and practices as left outer join (vocables without practice will be in the list)
-        stmt = db.session.query(Vocable, subquery.c.latest_timestamp)\
-            .join(subquery, subquery.c.vocable_id == Vocable.id, isouter=True).filter(Vocable.user_id == self.id)\
-                .order_by(subquery.c.latest_timestamp.asc()).filter(getattr(Vocable, target_language.iso) != '')\
+        # The latest timestamp of each vocable of the user in the practice table and the compacted practice
+        # days for the language, both are index lookups (no grouping of the practices of all users)
+        timestamps = sa.union_all(
+            sa.select(sa.func.max(Practice.timestamp).label('timestamp'))\
+                .filter(Practice.language_id == target_language.id, Practice.vocable_id == Vocable.id).correlate(Vocable),
+            sa.select(sa.func.max(PracticeDay.latest_timestamp))\
+                .filter(PracticeDay.language_id == target_language.id, PracticeDay.vocable_id == Vocable.id).correlate(Vocable)).subquery()
+        latest_timestamp = sa.select(sa.func.max(timestamps.c.timestamp)).correlate(Vocable).scalar_subquery().label('latest_timestamp')
+
+        # vocables without practice have no timestamp and come first
+        stmt = sa.select(Vocable, latest_timestamp).filter(Vocable.user_id == self.id)\
+                .order_by(latest_timestamp.asc()).filter(getattr(Vocable, target_language.iso) != '')\
                 .filter(getattr(Vocable, source_language.iso) != '')
         
         return stmt
     
 
             
+    def avatar(self, size: int) -> str:
+        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
+        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode({'reset_password':self.id, 'exp':time()+ expires_in},
                           app.config['SECRET_KEY'], algorithm='HS256')
@@ -176,7 +267,100 @@ class Language(db.Model): # type: ignore
 
     def __repr__(self):
         return f"<language {self.name}>"
-    
+
+
+class LanguageRecord(NamedTuple):
+    '''
+    Immutable copy of a row of the language table. It can be used instead of a 
+    Language instance wherever the language is only read (id, iso and name).
+    '''
+    id: int
+    iso: str
+    name: str
+
+
+class LanguageRegistry:
+    '''
+    In-process registry of all languages. The language table is loaded once per 
+    worker on first use and afterwards every lookup by id, iso or name is a dictionary
+    access. Call reload() or clear() whenever the language table changes. Changes made 
+    through the ORM clear the registry automatically.
+    '''
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._by_id: MappingProxyType[int, LanguageRecord] | None = None
+        self._by_iso: MappingProxyType[str, LanguageRecord] = MappingProxyType({})
+        self._by_name: MappingProxyType[str, LanguageRecord] = MappingProxyType({})
+
+    def _ensure_loaded(self) -> None:
+        if self._by_id is None:
+            with self._lock:
+                if self._by_id is None:
+                    self._load()
+
+    def _load(self) -> None:
+        query = sa.select(Language.id, Language.iso, Language.name).order_by(Language.id)
+        records = [LanguageRecord(*row) for row in db.session.execute(query)]
+        self._by_iso = MappingProxyType({r.iso: r for r in records})
+        self._by_name = MappingProxyType({r.name: r for r in records})
+        self._by_id = MappingProxyType({r.id: r for r in records})
+
+    def reload(self) -> None:
+        '''
+        Loads the language table again. Needs an application context.
+        '''
+        with self._lock:
+            self._load()
+
+    def clear(self) -> None:
+        '''
+        Drops the loaded languages. They are loaded again on the next lookup.
+        '''
+        with self._lock:
+            self._by_id = None
+
+    def get(self, id: int|str|None) -> LanguageRecord|None:
+        '''
+        Returns the language with the given id. The id may also be given as string
+        like it is stored in the session table.
+        '''
+        if id is None or id == '':
+            return None
+        self._ensure_loaded()
+        return self._by_id.get(int(id))  # type: ignore[union-attr]
+
+    def by_iso(self, iso: str) -> LanguageRecord|None:
+        self._ensure_loaded()
+        return self._by_iso.get(iso)
+
+    def by_name(self, name: str) -> LanguageRecord|None:
+        self._ensure_loaded()
+        return self._by_name.get(name)
+
+    def all(self) -> list[LanguageRecord]:
+        self._ensure_loaded()
+        return list(self._by_id.values())  # type: ignore[union-attr]
+
+
+language_registry = LanguageRegistry()
+
+@sa.event.listens_for(Language, 'after_insert')
+@sa.event.listens_for(Language, 'after_update')
+@sa.event.listens_for(Language, 'after_delete')
+def clear_language_registry(mapper, connection, target) -> None:
+    language_registry.clear()
+    so.object_session(target).info['languages_changed'] = True
+
+@sa.event.listens_for(so.Session, 'after_commit')
+def publish_language_changes(session) -> None:
+    if session.info.pop('languages_changed', False):
+        invalidation_bus.publish('languages')
+
+@invalidation_bus.subscribe_to('languages')
+def reload_language_registry(key: str|None, generation: int) -> None:
+    language_registry.clear()
+
 class Vocable(db.Model): # type: ignore
     __tablename__ = "vocable"
 
@@ -199,35 +383,69 @@ class Vocable(db.Model): # type: ignore
     it_lvl: so.Mapped[int] = so.mapped_column(default=0)
     es_lvl: so.Mapped[int] = so.mapped_column(default=0)
     pt_lvl: so.Mapped[int] = so.mapped_column(default=0)
-    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey('user.id'))
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey('user.id', ondelete='CASCADE'), index=True)
+    # raised by every update, e.g. for the keys of cached rows (last writer wins, no optimistic locking)
+    version_id: so.Mapped[int] = so.mapped_column(default=1, server_default='1', 
+                                                  onupdate=sa.literal_column('version_id') + 1)
     
-    practices: so.Mapped[list['Practice']]=so.relationship(back_populates='vocable', cascade="all, delete")
+    practices: so.Mapped[list['Practice']]=so.relationship(back_populates='vocable', cascade="all, delete", passive_deletes=True)
+    practice_days: so.Mapped[list['PracticeDay']]=so.relationship(back_populates='vocable', cascade="all, delete", passive_deletes=True)
     user: so.Mapped['User']=so.relationship(back_populates='vocables')
 
-
     
     def __repr__(self):
         return f"<Vocable {self.id}, English: {self.en}>"
     
+    def to_dict(self:Vocable, languages:list[Language]) -> dict:
+        '''
+        Returns the words and levels of the vocable in the given languages
+        as dictionary, e.g. for JSON responses.
+        '''
+        data = {'id': self.id}
+        for language in languages:
+            data[language.iso] = getattr(self, language.iso)
+            data[language.iso + '_lvl'] = getattr(self, language.iso + '_lvl')
+        return data
+
+    @classmethod
+    def next_level(cls, level:int, answer_correct:bool) -> int:
+        '''
+        Returns the level a vocable gets after a correct or wrong answer.
+        '''
+        if answer_correct:
+            return level + 1 if level < cls.MAX_LVL else level
+        return level - 1 if level > cls.MIN_LVL else level
+
     def rise_level(self:Vocable, language:Language) -> None:
         '''
         Rises the level of the vocable for the given language. 
         The maximum level is 6.
         '''
-        current_level = getattr(self, language.iso + "_lvl")
-        if current_level < self.MAX_LVL:
-            setattr(self,language.iso + "_lvl", current_level+1)
-            db.session.commit()
+        setattr(self, language.iso + "_lvl", self.next_level(getattr(self, language.iso + "_lvl"), True))
+        db.session.commit()
 
     def lower_level(self:Vocable, language:Language):
         '''
         Lowers the level of the vocable for the given language.
         The minimum level is 0.
         '''
-        current_level = getattr(self, language.iso + "_lvl")
-        if current_level > self.MIN_LVL:
-            setattr(self,language.iso + "_lvl", current_level-1)
-            db.session.commit()
+        setattr(self, language.iso + "_lvl", self.next_level(getattr(self, language.iso + "_lvl"), False))
+        db.session.commit()
+
+    def apply_answer(self:Vocable, answer:str, target_language:Language) -> bool:
+        '''
+        Grades an answer, sets the new level for the target language and adds the
+        Practice entry to the session the vocable belongs to. Nothing is committed,
+        so it can be used with the sync db.session as well as with an AsyncSession.
+        '''
+        answer_correct = answer == getattr(self, target_language.iso)
+        level = target_language.iso + "_lvl"
+        setattr(self, level, self.next_level(getattr(self, level), answer_correct))
+        session = so.object_session(self)
+        session.add(Practice(iscorrect=answer_correct, vocable_id=self.id, language_id=target_language.id))
+        LanguageStats.record_answers(session, self.user_id, target_language.id, 
+                                     datetime.now(timezone.utc).date(), int(answer_correct), 1)
+        return answer_correct
 
     def check_result_and_set_level(self:Vocable, answer:str, target_language:Language) -> bool:
         '''
@@ -235,13 +453,7 @@ class Vocable(db.Model): # type: ignore
         True otherwise it returns False. It also sets the new level of the vocable for 
         the target language (lower if false and higher if correct).
         '''
-        answer_correct = answer == getattr(self, target_language.iso)
-        if answer_correct: 
-            self.rise_level(target_language)
-            self.add_practice(True, target_language)
-        else:
-            self.lower_level(target_language)
-            self.add_practice(False, target_language)
+        answer_correct = self.apply_answer(answer, target_language)
         db.session.commit()
         return answer_correct
 
@@ -258,7 +470,7 @@ class Vocable(db.Model): # type: ignore
         Checks if a Vocable was already studied before. And returns
         True or False.
         '''
-        return True if self.practices else False
+        return True if self.practices or self.practice_days else False
      
 class Post(db.Model): # type: ignore
     '''
@@ -270,17 +482,24 @@ class Post(db.Model): # type: ignore
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     body: so.Mapped[str] = so.mapped_column(sa.String(500))
     timestamp: so.Mapped[datetime] = so.mapped_column(index=True, default=lambda: datetime.now(timezone.utc))
-    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True)
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id, ondelete='CASCADE'), index=True)
 
     author: so.Mapped[User] = so.relationship(back_populates='posts')
 
     def __repr__(self) -> str:
         return f"<Post {self.body}>"
+
+    @staticmethod
+    def get_query_of_feed() -> sa.Select:
+        '''
+        Returns the select statement of the posts on the index page, the latest first.
+        '''
+        return sa.select(Post).order_by(Post.timestamp.desc())
     
 class Session(db.Model): # type: ignore
     __tablename__="session"
 
-    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), primary_key=True)
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id, ondelete='CASCADE'), primary_key=True)
     source_language_id: so.Mapped[str] = so.mapped_column(sa.String(length=50),nullable=True)
     target_language_id: so.Mapped[str] = so.mapped_column(sa.String(length=50),nullable=True)    
     vocable_id: so.Mapped[int] = so.mapped_column(nullable=True)
@@ -297,12 +516,157 @@ class Session(db.Model): # type: ignore
 
 class Practice(db.Model): # type: ignore
     __tablename__ = 'practice'
+    # the latest practice of every vocable in a language is read from the index (get_due_vocable)
+    __table_args__ = (sa.Index('ix_practice_language_vocable_timestamp', 'language_id', 'vocable_id', 'timestamp'),
+                      # the client picks the key, so it is only unique per vocable (and per user, see app.packs)
+                      sa.UniqueConstraint('client_key', 'vocable_id'))
 
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     timestamp: so.Mapped[datetime] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
     iscorrect: so.Mapped[bool] = so.mapped_column(sa.Boolean, nullable=False)
-    vocable_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Vocable.id))
-    language_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Language.id))
+    vocable_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Vocable.id, ondelete='CASCADE'), index=True)
+    language_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Language.id, ondelete='CASCADE'))
+    client_key: so.Mapped[Optional[str]] = so.mapped_column(sa.String(64))  # dedupes offline results
 
     vocable: so.Mapped['Vocable']=so.relationship(back_populates='practices')
-    
\ No newline at end of file
+
+
+class PracticeDay(db.Model): # type: ignore
+    '''
+    Compacted Practice entries of one vocable in one language on one day. Practice
+    entries older than PRACTICE_RETENTION_DAYS are folded into this table by
+    app.retention.compact_practices.
+    '''
+    __tablename__ = 'practice_day'
+    __table_args__ = (sa.UniqueConstraint('vocable_id', 'language_id', 'day'),
+                      sa.Index('ix_practice_day_language_vocable_timestamp', 'language_id', 'vocable_id', 'latest_timestamp'))
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id, ondelete='CASCADE'), index=True)
+    vocable_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Vocable.id, ondelete='CASCADE'))
+    language_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Language.id, ondelete='CASCADE'))
+    day: so.Mapped[date] = so.mapped_column(sa.Date)
+    correct: so.Mapped[int] = so.mapped_column(default=0)
+    incorrect: so.Mapped[int] = so.mapped_column(default=0)
+    latest_timestamp: so.Mapped[datetime] = so.mapped_column()
+
+    vocable: so.Mapped['Vocable']=so.relationship(back_populates='practice_days')
+    
+
+class LearningDay(db.Model): # type: ignore
+    '''
+    Number of answers and correct answers of a user in one language on one day (UTC).
+    The counters are raised in the same transaction as the answer is graded.
+    '''
+    __tablename__ = 'learning_day'
+    __table_args__ = (sa.UniqueConstraint('user_id', 'language_id', 'day'),)
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id, ondelete='CASCADE'))
+    language_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Language.id, ondelete='CASCADE'))
+    day: so.Mapped[date] = so.mapped_column(sa.Date)
+    answers: so.Mapped[int] = so.mapped_column(default=0)
+    correct: so.Mapped[int] = so.mapped_column(default=0)
+
+
+class LanguageStats(db.Model): # type: ignore
+    '''
+    Totals and daily streak of a user in one language. The streak counts consecutive
+    days with at least one answer up to last_day.
+    '''
+    __tablename__ = 'language_stats'
+    __table_args__ = (sa.UniqueConstraint('user_id', 'language_id'),)
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id, ondelete='CASCADE'))
+    language_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Language.id, ondelete='CASCADE'))
+    answers: so.Mapped[int] = so.mapped_column(default=0)
+    correct: so.Mapped[int] = so.mapped_column(default=0)
+    current_streak: so.Mapped[int] = so.mapped_column(default=0)
+    longest_streak: so.Mapped[int] = so.mapped_column(default=0)
+    last_day: so.Mapped[Optional[date]] = so.mapped_column(sa.Date)
+
+    @property
+    def accuracy(self) -> float|None:
+        return self.correct / self.answers if self.answers else None
+
+    def streak_on(self, day: date) -> int:
+        '''
+        Returns the streak as it is on the given day. A streak is still alive on the
+        day after the last answer.
+        '''
+        if self.last_day is None or self.last_day < day - timedelta(days=1):
+            return 0
+        return self.current_streak
+
+    def add_day(self, day: date) -> None:
+        '''
+        Extends the streak with a day with answers. Days before last_day are ignored.
+        '''
+        if self.last_day is not None and day <= self.last_day:
+            return
+        if self.last_day is not None and day == self.last_day + timedelta(days=1):
+            self.current_streak += 1
+        else:
+            self.current_streak = 1
+        self.longest_streak = max(self.longest_streak, self.current_streak)
+        self.last_day = day
+
+    def replay_days(self, days: Iterable[date]) -> None:
+        '''
+        Computes the streaks again from all days with answers in ascending order.
+        '''
+        self.current_streak, self.longest_streak, self.last_day = 0, 0, None
+        for day in days:
+            self.add_day(day)
+
+    @staticmethod
+    def record_answers(session: so.Session, user_id: int, language_id: int, day: date, correct: int, answers: int) -> None:
+        '''
+        Adds answers given on a day to the LearningDay and LanguageStats rows of the
+        user in the given session. Nothing is committed. The counters are raised in
+        the database, so concurrent answers do not overwrite each other's counts. The
+        streak is updated after the LanguageStats row was locked by its upsert. Answers
+        of a day before the last day (synced offline answers) replay all learning days.
+        '''
+        upsert(session, LearningDay, {'user_id': user_id, 'language_id': language_id, 'day': day, 
+                                      'answers': answers, 'correct': correct}, 
+               ('user_id', 'language_id', 'day'), {'answers': answers, 'correct': correct})
+        upsert(session, LanguageStats, {'user_id': user_id, 'language_id': language_id, 'answers': answers, 
+                                        'correct': correct, 'current_streak': 0, 'longest_streak': 0}, 
+               ('user_id', 'language_id'), {'answers': answers, 'correct': correct})
+        stats = session.scalar(sa.select(LanguageStats).filter_by(user_id=user_id, language_id=language_id)
+                               .with_for_update().execution_options(populate_existing=True))
+        if stats.last_day is not None and day < stats.last_day:
+            stats.replay_days(session.scalars(sa.select(LearningDay.day).filter_by(user_id=user_id, language_id=language_id)
+                                              .order_by(LearningDay.day)))
+        else:
+            stats.add_day(day)
+
+
+def upsert(session: so.Session, model: type, values: dict, keys: tuple[str, ...], increments: dict[str, int]) -> None:
+    '''
+    Inserts a row with the values into the table of model or, if a row with the same
+    keys (a unique constraint) exists, adds the increments to its columns. On MySQL,
+    PostgreSQL and SQLite it is one statement, so concurrent upserts neither lose 
+    increments nor fail on the constraint. Other databases update the row and insert it
+    if it does not exist yet.
+    '''
+    table = model.__table__
+    dialect = session.get_bind(model).dialect.name
+    increment = {column: table.c[column] + n for column, n in increments.items()}
+    if dialect == 'mysql':
+        session.execute(mysql.insert(table).values(values).on_duplicate_key_update(increment))
+    elif dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        session.execute(insert(table).values(values).on_conflict_do_update(index_elements=keys, set_=increment))
+    else:
+        update = sa.update(table).where(*(table.c[key] == values[key] for key in keys)).values(increment)
+        if session.execute(update).rowcount == 0:
+            try:
+                with session.begin_nested():
+                    session.execute(sa.insert(table).values(values))
+            except sa.exc.IntegrityError:
+                # a concurrent transaction inserted the row first, otherwise the row is invalid
+                if session.execute(update).rowcount == 0:
+                    raise
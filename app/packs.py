@@ -0,0 +1,139 @@
+"""
+This module contains the offline practice of the polyglotpivot project. A client
+downloads a practice pack with the next due vocables of a language pair, grades the
+answers locally and later uploads the results as one batch.
+
+A pack is a gzip compressed JSON document:
+
+    {"version": 1, "source": "en", "target": "de", "created": "2026-01-01T12:00:00+00:00",
+     "fields": ["id", "version_id", "prompt", "answer", "level"],
+     "vocables": [[1, 3, "hello", "hallo", 2], ...]}
+
+The SHA-256 of the uncompressed document is sent in the X-Pack-SHA256 header.
+
+A batch of results is a JSON document (optionally gzip compressed):
+
+    {"version": 1, "target": "de",
+     "results": [{"key": "<unique key of the client>", "vocable_id": 1, "correct": true,
+                  "timestamp": "2026-01-01T12:03:00+00:00"}, ...]}
+
+apply_results applies a batch with a constant number of statements: the keys of the
+results make uploads of a user idempotent, the new levels are computed in the order of the
+timestamps and written with one executemany UPDATE, and the Practice entries are
+written with one multi-row INSERT.
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+from typing import NamedTuple
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from sqlalchemy.orm.exc import StaleDataError
+from app.models import Vocable, Practice, LanguageStats, LanguageRecord
+
+PACK_VERSION = 1
+PACK_FIELDS = ['id', 'version_id', 'prompt', 'answer', 'level']
+MAX_CLOCK_SKEW = timedelta(minutes=5)
+
+
+class Result(NamedTuple):
+    key: str
+    vocable_id: int
+    correct: bool
+    timestamp: datetime
+
+
+def encode_pack(vocables: list[Vocable], source: LanguageRecord, target: LanguageRecord) -> tuple[bytes, str]:
+    '''
+    Returns the gzip compressed pack of the vocables and the SHA-256 of the uncompressed pack.
+    '''
+    document = json.dumps({'version': PACK_VERSION,
+                           'source': source.iso,
+                           'target': target.iso,
+                           'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                           'fields': PACK_FIELDS,
+                           'vocables': [[vocable.id, vocable.version_id, getattr(vocable, source.iso),
+                                         getattr(vocable, target.iso), getattr(vocable, target.iso + '_lvl')]
+                                        for vocable in vocables]},
+                          separators=(',', ':')).encode()
+    return gzip.compress(document), hashlib.sha256(document).hexdigest()
+
+
+def parse_results(batch: dict, max_results: int) -> list[Result]:
+    '''
+    Validates the results of a batch. Raises ValueError if the batch is malformed.
+    '''
+    if batch.get('version') != PACK_VERSION:
+        raise ValueError(f'Only version {PACK_VERSION} of the batch format is supported.')
+    results = batch.get('results')
+    if not isinstance(results, list) or len(results) > max_results:
+        raise ValueError(f'A batch needs a list of at most {max_results} results.')
+    parsed = []
+    latest = datetime.now(timezone.utc) + MAX_CLOCK_SKEW
+    for result in results:
+        try:
+            key, vocable_id, correct = result['key'], result['vocable_id'], result['correct']
+            timestamp = datetime.fromisoformat(result['timestamp'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Every result needs a key, vocable_id, correct and an ISO timestamp.')
+        if not isinstance(key, str) or not 0 < len(key) <= 64 or type(vocable_id) is not int \
+                or not isinstance(correct, bool):
+            raise ValueError('Every result needs a key of up to 64 characters, an integer vocable_id and a boolean correct.')
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        if timestamp > latest:
+            raise ValueError(f'The timestamp of result {key} is in the future.')
+        parsed.append(Result(key, vocable_id, correct, timestamp.astimezone(timezone.utc)))
+    return parsed
+
+
+def apply_results(session: so.Session, user_id: int, target_language: LanguageRecord, results: list[Result]) -> dict:
+    '''
+    Applies the results of a batch in the session: sets the levels of the vocables,
+    adds the Practice entries and updates the learning statistics. Results whose key
+    was already applied for the user and results of vocables of other users are skipped. Nothing
+    is committed; the caller commits the batch as one transaction. Raises
+    StaleDataError if a vocable was changed concurrently.
+    '''
+    unique = {result.key: result for result in results}
+    applied_keys = set(session.scalars(sa.select(Practice.client_key).join(Vocable, Vocable.id == Practice.vocable_id)
+                                       .where(Vocable.user_id == user_id, Practice.client_key.in_(unique))))
+    new = sorted((result for key, result in unique.items() if key not in applied_keys),
+                 key=lambda result: result.timestamp)
+
+    level_column = getattr(Vocable, target_language.iso + '_lvl')
+    vocables = {row.id: [row.level, row.version_id] for row in session.execute(
+        sa.select(Vocable.id, level_column.label('level'), Vocable.version_id)
+        .where(Vocable.user_id == user_id, Vocable.id.in_({result.vocable_id for result in new})))}
+    rejected = [result.key for result in new if result.vocable_id not in vocables]
+    new = [result for result in new if result.vocable_id in vocables]
+
+    levels = {id: level for id, (level, _) in vocables.items()}
+    for result in new:
+        levels[result.vocable_id] = Vocable.next_level(levels[result.vocable_id], result.correct)
+    practiced = sorted({result.vocable_id for result in new})
+    changed = [{'b_id': id, 'b_version_id': vocables[id][1], 'b_level': levels[id]} for id in practiced]
+
+    if changed:
+        table = Vocable.__table__
+        update = sa.update(table)\
+            .where(table.c.id == sa.bindparam('b_id'), table.c.version_id == sa.bindparam('b_version_id'))\
+            .values({level_column.key: sa.bindparam('b_level'), 'version_id': table.c.version_id + 1})
+        if session.execute(update, changed).rowcount != len(changed):
+            raise StaleDataError('A vocable of the batch was changed concurrently.')
+        session.execute(sa.insert(Practice).values([
+            {'client_key': result.key, 'vocable_id': result.vocable_id, 'language_id': target_language.id,
+             'iscorrect': result.correct, 'timestamp': result.timestamp} for result in new]))
+        for day, day_results in groupby(new, key=lambda result: result.timestamp.date()):
+            day_results = list(day_results)
+            LanguageStats.record_answers(session, user_id, target_language.id, day,
+                                         sum(result.correct for result in day_results), len(day_results))
+    return {'applied': len(new),
+            'duplicates': len(results) - len(new) - len(rejected),
+            'rejected': rejected,
+            'levels': {str(id): levels[id] for id in practiced}}
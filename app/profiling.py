@@ -0,0 +1,215 @@
+"""
+This module contains the request profiler of the polyglotpivot project. It is only
+active if PROFILING is set; otherwise no hook is registered and requests are not
+slowed down at all.
+
+A request is profiled with cProfile if an admin sends the header X-Profile: 1 or
+the query parameter ?profile=1, or by chance with a probability of 1 in
+PROFILE_SAMPLE_RATE. The pstats file, the SQL statements of the request and a small
+JSON summary are written to PROFILE_DIR, which keeps the latest PROFILE_KEEP
+profiles. The profiles are listed on /admin/profiles.
+
+The coroutines of a request run on the event loop of app.async_db, which is shared
+by all requests of the worker. Their profiler is only enabled while a step of the
+request's own coroutine runs, so other requests' coroutines are not counted.
+
+    python -m pstats profiles/<name>.prof
+"""
+
+from __future__ import annotations
+
+import cProfile
+import json
+import types
+import os
+import pstats
+import random
+import threading
+import uuid
+from datetime import datetime, timezone
+from time import perf_counter
+import sqlalchemy as sa
+from flask import current_app, g, has_request_context, request
+from flask_login import current_user
+
+
+def is_admin() -> bool:
+    return current_user.is_authenticated and current_user.is_admin
+
+
+class RequestProfile:
+    '''
+    Collects the cProfile data of all threads that serve one request (the request
+    thread and the event loop thread of app.async_db) and its SQL statements.
+    '''
+
+    def __init__(self) -> None:
+        self.id = uuid.uuid4().hex[:12]
+        self.started = perf_counter()
+        self.profilers: list[cProfile.Profile] = []
+        self.statements: list[tuple[float, str]] = []
+        self._lock = threading.Lock()
+
+    def enable(self) -> cProfile.Profile|None:
+        '''
+        Starts profiling the current thread. Returns None if another profiler is
+        already active in the thread.
+        '''
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return None
+        with self._lock:
+            self.profilers.append(profiler)
+        return profiler
+
+    def add_profiler(self) -> cProfile.Profile:
+        '''
+        Returns a new profiler of the request, which is not enabled yet.
+        '''
+        profiler = cProfile.Profile()
+        with self._lock:
+            self.profilers.append(profiler)
+        return profiler
+
+    def add_statement(self, duration: float, statement: str) -> None:
+        with self._lock:
+            self.statements.append((duration, statement))
+
+    def save(self, directory: str, keep: int, endpoint: str|None, status: int) -> str|None:
+        '''
+        Writes the profile to directory and deletes the oldest profiles, so at most keep
+        profiles are left. Returns the name of the profile.
+        '''
+        if not self.profilers:
+            return None
+        stats = pstats.Stats(self.profilers[0])
+        for profiler in self.profilers[1:]:
+            stats.add(profiler)
+        now = datetime.now(timezone.utc)
+        name = f'{now:%Y%m%dT%H%M%S%f}-{endpoint or "unknown"}-{self.id}'
+        os.makedirs(directory, exist_ok=True)
+        stats.dump_stats(os.path.join(directory, name + '.prof'))
+        with open(os.path.join(directory, name + '.sql'), 'w') as file:
+            for duration, statement in self.statements:
+                file.write(f'-- {duration * 1000:.2f} ms\n{statement};\n\n')
+        with open(os.path.join(directory, name + '.json'), 'w') as file:
+            json.dump({'name': name,
+                       'time': now.isoformat(timespec='seconds'),
+                       'method': request.method,
+                       'path': request.full_path.rstrip('?'),
+                       'status': status,
+                       'duration_ms': round((perf_counter() - self.started) * 1000, 2),
+                       'sql_count': len(self.statements),
+                       'sql_ms': round(sum(duration for duration, _ in self.statements) * 1000, 2)}, file)
+        for old in list_profiles(directory)[keep:]:
+            for extension in ('.prof', '.sql', '.json'):
+                try:
+                    os.remove(os.path.join(directory, old['name'] + extension))
+                except FileNotFoundError:
+                    pass
+        return name
+
+
+def list_profiles(directory: str) -> list[dict]:
+    '''
+    Returns the summaries of the profiles in directory, the latest first.
+    '''
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for file_name in sorted(os.listdir(directory), reverse=True):
+        if file_name.endswith('.json'):
+            try:
+                with open(os.path.join(directory, file_name)) as file:
+                    profiles.append(json.load(file))
+            except (OSError, ValueError):
+                continue  # removed or still written by another worker
+    return profiles
+
+
+def should_profile() -> bool:
+    if request.endpoint in ('static', 'profiles', 'download_profile'):
+        return False
+    if (request.headers.get('X-Profile') or request.args.get('profile')) == '1' and is_admin():
+        return True
+    rate = current_app.config['PROFILE_SAMPLE_RATE']
+    return rate > 0 and random.randrange(rate) == 0
+
+
+def start_profile() -> None:
+    if should_profile():
+        g.profile = RequestProfile()
+        g.profiler = g.profile.enable()
+
+
+def stop_profile(response):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        if g.get('profiler') is not None:
+            g.profiler.disable()
+        try:
+            name = profile.save(current_app.config['PROFILE_DIR'], current_app.config['PROFILE_KEEP'],
+                                request.endpoint, response.status_code)
+            if name:
+                response.headers['X-Profile-Name'] = name
+        except OSError:
+            current_app.logger.exception('The profile of the request could not be saved.')
+    return response
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    if has_request_context() and g.get('profile') is not None:
+        conn.info.setdefault('profile_started', []).append(perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    if has_request_context() and g.get('profile') is not None and conn.info.get('profile_started'):
+        g.profile.add_statement(perf_counter() - conn.info['profile_started'].pop(), statement)
+
+
+@types.coroutine
+def profile_steps(coroutine, profiler: cProfile.Profile):
+    '''
+    Runs the coroutine and enables the profiler only while one of its steps runs. While
+    the coroutine waits, the event loop runs other tasks, which are not profiled.
+    '''
+    value, error = None, None
+    while True:
+        profiler.enable()
+        try:
+            future = coroutine.throw(error) if error is not None else coroutine.send(value)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            profiler.disable()
+        try:
+            value, error = (yield future), None
+        except BaseException as exception:
+            value, error = None, exception
+
+
+def profile_coroutine(coroutine):
+    '''
+    Returns the coroutine, profiled in the thread of the event loop that runs it if the
+    current request is profiled.
+    '''
+    if not has_request_context() or g.get('profile') is None:
+        return coroutine
+    profiler = g.profile.add_profiler()
+    async def profiled():
+        return await profile_steps(coroutine, profiler)
+    return profiled()
+
+
+def init_profiling(app) -> None:
+    '''
+    Registers the profiling hooks if PROFILING is set.
+    '''
+    if not app.config['PROFILING']:
+        return
+    app.before_request(start_profile)
+    app.after_request(stop_profile)
+    sa.event.listen(sa.Engine, 'before_cursor_execute', before_cursor_execute)
+    sa.event.listen(sa.Engine, 'after_cursor_execute', after_cursor_execute)
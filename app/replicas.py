@@ -0,0 +1,242 @@
+"""
+This module routes the reads of read-only views and model helpers to read replicas
+of the database. Writes always go to the primary (SQLALCHEMY_DATABASE_URI). After a
+user wrote something, his reads stick to the primary for REPLICA_STICKY_SECONDS,
+so he always reads his own writes. Replicas that fail a health check are skipped
+for REPLICA_RETRY_SECONDS. The health checks run in a background thread of every
+worker process, so a replica that is down never blocks a request or the event loop
+of app.async_db; a session only reads the cached health state.
+
+This module is imported before the flask-sqlalchemy extension is created and
+therefore only uses current_app.
+"""
+
+from __future__ import annotations
+
+import inspect
+import itertools
+import os
+import threading
+from functools import wraps
+from time import monotonic, time
+from typing import Any, Callable
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from flask import current_app, g, has_request_context, session
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+STICKY_KEY = '_primary_until'  # key in the flask session cookie
+
+
+class ReplicaRouter:
+    '''
+    Keeps one engine per replica uri and decides which engine serves a read.
+    '''
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._engines: dict[str, sa.Engine] = {}
+        self._async_engines: dict[str, AsyncEngine] = {}
+        self._checked_at: dict[str, float] = {}
+        self._down_until: dict[str, float] = {}
+        self._healthy: set[str] = set()
+        self._counter = itertools.count()
+        self._checker_pid: int | None = None
+        self._wake = threading.Event()
+
+    def init_app(self, app) -> None:
+        @app.before_request
+        def reset_request_state() -> None:
+            g.read_only = False
+            g.wrote = False
+
+    def reset(self) -> None:
+        '''
+        Disposes all replica engines and forgets the health state.
+        '''
+        # imported here, because app.async_db imports the models
+        from app.async_db import async_db
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            for async_engine in self._async_engines.values():
+                # the pooled connections belong to the event loop of the worker
+                async_db.run(async_engine.dispose())
+            self._engines.clear()
+            self._async_engines.clear()
+            self._checked_at.clear()
+            self._down_until.clear()
+            self._healthy.clear()
+
+    def reads_from_replica(self) -> bool:
+        '''
+        Returns True if reads of the current request may be served by a replica.
+        '''
+        if not has_request_context() or not current_app.config['SQLALCHEMY_REPLICA_URIS']:
+            return False
+        if not g.get('read_only') or g.get('wrote'):
+            return False
+        return session.get(STICKY_KEY, 0) < time()
+
+    def mark_write(self) -> None:
+        '''
+        Lets the reads of the current user stick to the primary for a while.
+        '''
+        if has_request_context():
+            g.wrote = True
+            session[STICKY_KEY] = time() + current_app.config['REPLICA_STICKY_SECONDS']
+
+    def engine(self, uri: str) -> sa.Engine:
+        with self._lock:
+            if uri not in self._engines:
+                self._engines[uri] = sa.create_engine(uri, pool_pre_ping=True)
+                sa.event.listen(self._engines[uri], 'handle_error', self._handle_error(uri))
+            return self._engines[uri]
+
+    def async_engine(self, uri: str) -> AsyncEngine:
+        # imported here, because app.async_db imports the models
+        from app.async_db import async_database_uri
+        with self._lock:
+            if uri not in self._async_engines:
+                self._async_engines[uri] = create_async_engine(async_database_uri(uri), pool_pre_ping=True,
+                                                               pool_size=current_app.config['ASYNC_POOL_SIZE'])
+                sa.event.listen(self._async_engines[uri].sync_engine, 'handle_error', self._handle_error(uri))
+            return self._async_engines[uri]
+
+    def _handle_error(self, uri: str) -> Callable[[Any], None]:
+        def handle_error(context) -> None:
+            if context.is_disconnect:
+                self._mark_down(uri)
+        return handle_error
+
+    def _mark_down(self, uri: str) -> None:
+        self._down_until[uri] = monotonic() + current_app.config['REPLICA_RETRY_SECONDS']
+        current_app.logger.warning('Replica %s is down, reads go to the primary.',
+                                   sa.make_url(uri).render_as_string(hide_password=True))
+
+    def is_healthy(self, uri: str) -> bool:
+        '''
+        Returns the cached health of the replica: False while it is marked as down or
+        until its first check passed. It never connects to the replica.
+        '''
+        self._start_checker()
+        if uri not in self._checked_at:
+            self._wake.set()
+        return uri in self._healthy and self._down_until.get(uri, 0) <= monotonic()
+
+    def check_health(self) -> None:
+        '''
+        Checks the replicas that are not marked as down with SELECT 1 and caches the
+        result for is_healthy. Needs an application context.
+        '''
+        for uri in current_app.config['SQLALCHEMY_REPLICA_URIS']:
+            if self._down_until.get(uri, 0) > monotonic():
+                continue
+            self._checked_at[uri] = monotonic()
+            try:
+                with self.engine(uri).connect() as connection:
+                    connection.execute(sa.text('SELECT 1'))
+            except sa.exc.DBAPIError:
+                self._healthy.discard(uri)
+                self._mark_down(uri)
+            else:
+                self._healthy.add(uri)
+
+    def _start_checker(self) -> None:
+        if self._checker_pid != os.getpid():
+            with self._lock:
+                if self._checker_pid != os.getpid():
+                    # the thread of the parent does not exist in a forked process
+                    self._wake = threading.Event()
+                    threading.Thread(target=self._check_forever, args=(current_app._get_current_object(),),
+                                     name='replica-health', daemon=True).start()
+                    self._checker_pid = os.getpid()
+
+    def _check_forever(self, app) -> None:
+        with app.app_context():
+            while True:
+                # cleared before the check, so a replica added meanwhile is checked right after it
+                self._wake.clear()
+                try:
+                    self.check_health()
+                except Exception:
+                    app.logger.exception('The health check of the replicas failed.')
+                self._wake.wait(app.config['REPLICA_HEALTH_CHECK_SECONDS'])
+
+    def replica(self, is_async: bool = False) -> sa.Engine|None:
+        '''
+        Returns the (sync) engine of a healthy replica in round robin order or None if
+        no replica is healthy. For async sessions the sync_engine of the async engine
+        is returned. Only the cached health state is read, so it does not block.
+        '''
+        uris = current_app.config['SQLALCHEMY_REPLICA_URIS']
+        start = next(self._counter)
+        for i in range(len(uris)):
+            uri = uris[(start + i) % len(uris)]
+            if self.is_healthy(uri):
+                return self.async_engine(uri).sync_engine if is_async else self.engine(uri)
+        return None
+
+
+replica_router = ReplicaRouter()
+
+
+class RoutingMixin:
+    '''
+    Session get_bind that sends writes to the primary and reads of read-only
+    requests to a replica.
+    '''
+    is_async = False
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, sa.sql.dml.UpdateBase):  # type: ignore[attr-defined]
+            replica_router.mark_write()
+        elif kwargs.get('bind') is None and replica_router.reads_from_replica():
+            engine = replica_router.replica(self.is_async)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)  # type: ignore[misc]
+
+
+class RoutingSession(RoutingMixin, FlaskSQLAlchemySession):
+    '''
+    Session class of the flask-sqlalchemy extension.
+    '''
+
+
+class AsyncRoutingSession(RoutingMixin, so.Session):
+    '''
+    Session class behind the AsyncSession of app.async_db.
+    '''
+    is_async = True
+
+
+def read_only(f):
+    '''
+    Marks a view or a model helper as read-only. Its reads may be served by a replica.
+    Writes are still possible, they go to the primary and switch the rest of the
+    request to the primary.
+    '''
+    if inspect.iscoroutinefunction(f):
+        @wraps(f)
+        async def decorated_async(*args, **kwargs):
+            previous = g.get('read_only', False)
+            g.read_only = True
+            try:
+                return await f(*args, **kwargs)
+            finally:
+                g.read_only = previous
+        return decorated_async
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not has_request_context():
+            return f(*args, **kwargs)
+        previous = g.get('read_only', False)
+        g.read_only = True
+        try:
+            return f(*args, **kwargs)
+        finally:
+            g.read_only = previous
+    return decorated
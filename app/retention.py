@@ -0,0 +1,130 @@
+"""
+This module contains the retention of the practice log. Practice entries older than
+PRACTICE_RETENTION_DAYS are archived to gzip compressed NDJSON files and folded into
+per-(user, vocable, language, day) PracticeDay aggregates.
+"""
+
+from __future__ import annotations
+
+import fcntl
+import gzip
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import sqlalchemy as sa
+from app import app, db
+from app.models import Practice, PracticeDay, Vocable
+
+
+def archive_rows(rows: list[sa.Row], archive_dir: str) -> str:
+    '''
+    Writes the practice rows to a gzip compressed NDJSON file named after the first
+    and last practice id and returns its path. The file is complete on disk before
+    the function returns, so the rows can be deleted afterwards. Archiving the same
+    rows again overwrites the file.
+    '''
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f'practice-{rows[0].id:012d}-{rows[-1].id:012d}.ndjson.gz')
+    with open(path + '.tmp', 'wb') as file:
+        with gzip.GzipFile(fileobj=file, mode='wb') as archive:
+            for row in rows:
+                archive.write(json.dumps({'id': row.id,
+                                          'timestamp': row.timestamp.isoformat(),
+                                          'iscorrect': row.iscorrect,
+                                          'vocable_id': row.vocable_id,
+                                          'language_id': row.language_id,
+                                          'user_id': row.user_id}).encode() + b'\n')
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def fold_rows(rows: list[sa.Row]) -> None:
+    '''
+    Adds the practice rows to the PracticeDay aggregates in the current transaction.
+    '''
+    days: dict[tuple, list] = {}
+    for row in rows:
+        key = (row.vocable_id, row.language_id, row.timestamp.date())
+        counts = days.setdefault(key, [row.user_id, 0, 0, row.timestamp])
+        counts[1 if row.iscorrect else 2] += 1
+        counts[3] = max(counts[3], row.timestamp)
+
+    query = sa.select(PracticeDay).where(
+        sa.tuple_(PracticeDay.vocable_id, PracticeDay.language_id, PracticeDay.day).in_(list(days)))
+    existing = {(d.vocable_id, d.language_id, d.day): d for d in db.session.scalars(query)}
+    for (vocable_id, language_id, day), (user_id, correct, incorrect, latest) in days.items():
+        practice_day = existing.get((vocable_id, language_id, day))
+        if practice_day is None:
+            db.session.add(PracticeDay(user_id=user_id, vocable_id=vocable_id, language_id=language_id,
+                                       day=day, correct=correct, incorrect=incorrect, latest_timestamp=latest))
+        else:
+            practice_day.correct += correct
+            practice_day.incorrect += incorrect
+            practice_day.latest_timestamp = max(practice_day.latest_timestamp, latest)
+
+
+def compact_practices(horizon_days: int, batch_size: int, archive_dir: str) -> int:
+    '''
+    Archives and folds all Practice entries older than horizon_days in batches of
+    batch_size rows. Every batch is one transaction: the aggregates are updated and
+    the archived rows are deleted together. Returns the number of compacted rows.
+    '''
+    cutoff = datetime.now(timezone.utc) - timedelta(days=horizon_days)
+    query = sa.select(Practice.id, Practice.timestamp, Practice.iscorrect, Practice.vocable_id,
+                      Practice.language_id, Vocable.user_id)\
+        .join(Vocable, Vocable.id == Practice.vocable_id)\
+        .where(Practice.timestamp < cutoff).order_by(Practice.id).limit(batch_size)
+    compacted = 0
+    while rows := db.session.execute(query).all():
+        archive_rows(rows, archive_dir)
+        fold_rows(rows)
+        db.session.execute(sa.delete(Practice).where(Practice.id.in_([row.id for row in rows])),
+                           execution_options={'synchronize_session': False})
+        db.session.commit()
+        compacted += len(rows)
+    return compacted
+
+
+def compact_practices_locked(horizon_days: int|None = None, batch_size: int|None = None, 
+                             archive_dir: str|None = None) -> int|None:
+    '''
+    Runs compact_practices, unless another process or thread holds the lock file. Two
+    compactions at the same time could fold the same rows twice. The arguments default
+    to the settings of the app config. The lock file is always in PRACTICE_ARCHIVE_DIR,
+    also if the rows are archived to another directory. Returns None if the lock is held.
+    '''
+    lock_dir = app.config['PRACTICE_ARCHIVE_DIR']
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, '.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        try:
+            return compact_practices(horizon_days if horizon_days is not None else app.config['PRACTICE_RETENTION_DAYS'],
+                                     batch_size or app.config['PRACTICE_COMPACTION_BATCH_SIZE'], 
+                                     archive_dir or lock_dir)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def run_scheduled_compaction() -> None:
+    while True:
+        time.sleep(app.config['PRACTICE_COMPACTION_INTERVAL'])
+        with app.app_context():
+            try:
+                compacted = compact_practices_locked()
+                if compacted:
+                    app.logger.info('Compacted %d practice entries.', compacted)
+            except Exception:
+                app.logger.exception('Compaction of the practice log failed.')
+            finally:
+                db.session.remove()
+
+
+if app.config['PRACTICE_COMPACTION_INTERVAL']:
+    threading.Thread(target=run_scheduled_compaction, name='practice-compaction', daemon=True).start()
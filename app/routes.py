@@ -1,19 +1,25 @@
 from app import app, db
-from flask import redirect, render_template, url_for, flash, request
+from flask import redirect, render_template, url_for, flash, request, abort, send_from_directory
 from app.forms import LoginForm, RegistrationForm, EditProfileForm, AddPostForm, ResetPasswordForm
 from app.forms import AddVocableForm, PracticeForm, ConfigPracticeForm, EmptyForm, ResetPasswordRequestForm
 from flask_login import current_user, login_user, logout_user, login_required
 from urllib.parse import urlsplit
 import sqlalchemy as sa 
-from app.models import User, Post, Language, Vocable, Session
+from app.models import User, Post, Vocable, Session, language_registry
+from app.async_db import async_db, get_practice_session, get_user_language_ids, get_vocables_page, set_due_vocable, grade_answer
 from datetime import datetime, timezone
 from app.email import send_password_reset_email
+from app.replicas import read_only
+from app.stats import get_language_stats, get_daily_activity
+from app.profiling import is_admin, list_profiles
+from app.admission import admission_controller
 
 @app.route('/')
 @app.route('/index', methods=["GET","POST"])
+@read_only
 def index():
     if current_user.is_authenticated:
-        if not current_user.languages:
+        if not current_user.get_languages():
             flash(f"Hi {current_user.username}. Nice to see a new face here. \
                   You can configure your profile on this page. If you want you can \
                   Write some nice words about you.\
@@ -32,8 +38,7 @@ def index():
     else:
         flash("This website is under active development.","info")
     page = request.args.get('page', 1, type=int)
-    query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query ,page=page, per_page=app.config["POSTS_PER_PAGE"], error_out=False)
+    posts = db.paginate(Post.get_query_of_feed(), page=page, per_page=app.config["POSTS_PER_PAGE"], error_out=False)
     next_url = url_for('index', page=posts.next_num) if posts.has_next else None
     prev_url = url_for('index', page=posts.prev_num) if posts.has_prev else None
     return render_template("index.html", title="Home", posts=posts.items, form=form, next_url=next_url, prev_url=prev_url)
@@ -50,7 +55,8 @@ def login():
             flash('Invalid username or password', 'danger')
             return redirect(url_for('login'))
         login_user(user, remember=form.remember_me.data)
-        print(f"REMEMBER ME: {form.remember_me.data}")
+        user.last_seen = datetime.now(timezone.utc)
+        db.session.commit()
         next_page = request.args.get('next')
         if not next_page or urlsplit(next_page).netloc != '':
             next_page = url_for('index')
@@ -80,25 +86,31 @@ def register():
     return render_template("register.html", form=form)
 
 @app.route("/user/<username>")
+@read_only
 @login_required  
-def before_request():
-    if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+def user(username):
+    user = db.first_or_404(sa.select(User).where(User.username == username))
+    query = sa.select(Post).where(Post.user_id == user.id).order_by(Post.timestamp.desc()).limit(app.config["POSTS_PER_PAGE"])
+    posts = db.session.scalars(query).all()
+    days = min(max(request.args.get('days', app.config["STATS_DAYS"], type=int), 1), 366)
+    return render_template("user.html", user=user, posts=posts, 
+                           language_stats=get_language_stats(user.id), 
+                           activity=get_daily_activity(user.id, days))
 
 @app.route("/edit_profile",methods=["GET","POST"])
 @login_required
 def edit_profile(): 
     form = EditProfileForm()
-    languages = db.session.scalars(sa.select(Language.name)).all() # get all available languages
+    languages = [l.name for l in language_registry.all()] # get all available languages
     form.languages.choices = languages # sets the available languages
-    form.languages.data = [l.name for l in current_user.languages] # preselect the languages the user already has
+    form.languages.data = [l.name for l in current_user.get_languages()] # preselect the languages the user already has
     if form.validate_on_submit():
         form.languages.data = request.form.getlist('languages') # this updates the data according to the selection in the browser.
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
         current_user.set_languages(form.languages.data)
         db.session.commit()
+        current_user.invalidate_caches()
         flash("Your changes have been saved.", 'success')
         return redirect(url_for('edit_profile'))
     elif request.method == "GET":
@@ -107,22 +119,27 @@ def edit_profile():
     return render_template("edit_profile.html",title="Edit Profile", form=form)
 
 @app.route("/vocabulary",methods=["GET"])
+@read_only
 @login_required
 def vocabulary():
     page = request.args.get('page', 1, type=int)
-    query = sa.select(Vocable).where(Vocable.user_id == current_user.id)
-    vocables = db.paginate(query, page=page, per_page=app.config["VOCABLES_PER_PAGE"], error_out=False)
-    next_url = url_for('vocabulary', page=vocables.next_num) if vocables.has_next else None
-    prev_url = url_for('vocabulary', page=vocables.prev_num) if vocables.has_prev else None
-    return render_template("vocabulary.html",title="Your Vocabulary", vocables=vocables, next_url=next_url, prev_url=prev_url)
+    with async_db.view_session() as session:
+        language_ids = async_db.run(get_user_language_ids(session, current_user.id))
+        vocables, has_next = async_db.run(get_vocables_page(session, current_user.id, page, app.config["VOCABLES_PER_PAGE"]))
+    languages = [language_registry.get(id) for id in language_ids]
+    next_url = url_for('vocabulary', page=page + 1) if has_next else None
+    prev_url = url_for('vocabulary', page=page - 1) if page > 1 else None
+    return render_template("vocabulary.html",title="Your Vocabulary", vocables=vocables, languages=languages, 
+                           next_url=next_url, prev_url=prev_url, page=page, form=EmptyForm())
 
 @app.route("/add_vocable", methods=["GET","POST"])
 @login_required
 def add_vocable():
     form = AddVocableForm()
+    languages = current_user.get_languages()
     if form.validate_on_submit():
         vocable_data = {}
-        for language in current_user.languages:
+        for language in languages:
             vocable_data[language.iso] = form[language.iso].data
         new_vocable = Vocable(**vocable_data)
         current_user.vocables.append(new_vocable)
@@ -130,15 +147,23 @@ def add_vocable():
         db.session.commit()
         flash("New vocable was added successfully.","success")
         return redirect(url_for('add_vocable'))
-    return render_template("add_vocable.html", form=form)
+    return render_template("add_vocable.html", form=form, languages=languages)
 
 @app.route("/delete_vocable/<vocable_id>",methods=["GET"])
 @login_required
 def delete_vocable(vocable_id):
-    db.session.delete(db.session.get(Vocable,vocable_id))
-    db.session.commit()
+    current_user.delete_vocables([vocable_id])
     return redirect(url_for('vocabulary'))
 
+@app.route("/delete_vocables", methods=["POST"])
+@login_required
+def delete_vocables():
+    form = EmptyForm()
+    if form.validate_on_submit():
+        deleted = current_user.delete_vocables(request.form.getlist('vocable_ids', type=int))
+        flash(f"{deleted} vocables were deleted.", "success")
+    return redirect(url_for('vocabulary', page=request.args.get('page', 1, type=int)))
+
 @app.route("/practice", methods=["GET","POST"])
 @login_required
 def practice(): 
@@ -146,21 +171,24 @@ def practice():
     result = None
     vocable = None
     next_vocable_autofocus = False
-    if not current_user.session.target_language_id:
-        return redirect(url_for("config_practice"))
-    
-    vocable = db.session.get(Vocable, current_user.session.vocable_id)
-    target_language = db.session.get(Language, current_user.session.target_language_id) 
-    source_language = db.session.get(Language, current_user.session.source_language_id) 
-    if form.submit.data and form.validate():
-        if not current_user.session.vocable_id:
-            redirect(url_for("new_vocable"))
-        result = vocable.check_result_and_set_level(form.your_answer.data, target_language) 
-        if result:
-            flash("Your answer is correct!", "success")
-            next_vocable_autofocus = True
-        else: 
-            flash(f'The right answer would be: "{getattr(vocable, target_language.iso)}"', "danger") 
+    with async_db.view_session() as session:
+        practice_session = async_db.run(get_practice_session(session, current_user.id))
+        if not practice_session.target_language_id:
+            return redirect(url_for("config_practice"))
+        
+        if practice_session.vocable_id:
+            vocable = async_db.run(session.get(Vocable, practice_session.vocable_id))
+        target_language = language_registry.get(practice_session.target_language_id) 
+        source_language = language_registry.get(practice_session.source_language_id) 
+        if form.submit.data and form.validate():
+            if vocable is None:
+                return redirect(url_for("new_vocable"))
+            result = async_db.run(grade_answer(session, vocable, form.your_answer.data, target_language))
+            if result:
+                flash("Your answer is correct!", "success")
+                next_vocable_autofocus = True
+            else: 
+                flash(f'The right answer would be: "{getattr(vocable, target_language.iso)}"', "danger") 
       
     return render_template("practice.html",form=form,target_language = target_language, source_language = source_language, vocable=vocable, next_vocable_autofocus=next_vocable_autofocus)
 
@@ -168,13 +196,13 @@ def practice():
 @login_required
 def config_practice():
     form = ConfigPracticeForm()
-    languages = current_user.languages
+    languages = current_user.get_languages()
     language_list = [l.name for l in languages]
     form.source_language.choices=language_list
     form.target_language.choices=language_list
     if form.validate_on_submit():
-        current_user.session.source_language_id = db.session.scalar(sa.select(Language.id).where(Language.name == form.source_language.data))
-        current_user.session.target_language_id = db.session.scalar(sa.select(Language.id).where(Language.name == form.target_language.data))
+        current_user.session.source_language_id = language_registry.by_name(form.source_language.data).id
+        current_user.session.target_language_id = language_registry.by_name(form.target_language.data).id
         db.session.commit()
         return redirect(url_for("practice"))
     return render_template("config_practice.html", form=form)
@@ -182,12 +210,14 @@ def config_practice():
 @app.route("/new_vocable", methods=["GET"])
 @login_required
 def new_vocable():
-    target_language = db.session.get(Language, current_user.session.target_language_id)
-    source_language = db.session.get(Language, current_user.session.source_language_id)
-    res = current_user.get_due_vocable(source_language, target_language)[0]
-    current_user.session.vocable_id =res.id
-    db.session.commit()
-    if current_user.session.vocable_id:
+    with async_db.view_session() as session:
+        practice_session = async_db.run(get_practice_session(session, current_user.id))
+        if not practice_session.target_language_id:
+            return redirect(url_for("config_practice"))
+        source_language = language_registry.get(practice_session.source_language_id)
+        target_language = language_registry.get(practice_session.target_language_id)
+        vocable = async_db.run(set_due_vocable(session, current_user, practice_session, source_language, target_language))
+    if vocable:
         return redirect(url_for("practice"))
     else:
         flash("To practice, you first have to add vocabulary.", "danger")
@@ -227,15 +257,39 @@ def edit_vocable(vocable_id):
     vocable = db.session.get(Vocable, vocable_id)
     if vocable.user == current_user:
         form = AddVocableForm(obj=vocable)  # Populate the form with existing data
+        languages = current_user.get_languages()
 
         if form.validate_on_submit():
             
             # Update the existing vocable with the new form data
-            for language in current_user.languages:
+            for language in languages:
                 vocable.__setattr__(language.iso, form[language.iso].data)
             db.session.commit()
+            current_user.invalidate_caches()
             flash("Vocable was successfully updated.", "success")
             return redirect(url_for("vocabulary"))  # Adjust the redirect URL as needed
     else:
         return redirect(url_for("index"))
-    return render_template("edit_vocable.html", form=form, vocable_id=vocable_id)
+    return render_template("edit_vocable.html", form=form, vocable_id=vocable_id, languages=languages)
+
+@app.route("/admin/profiles", methods=["GET"])
+@login_required
+def profiles():
+    if not is_admin():
+        abort(404)
+    return render_template("profiles.html", title="Profiles", profiling=app.config["PROFILING"],
+                           profiles=list_profiles(app.config["PROFILE_DIR"]))
+
+@app.route("/admin/profiles/<filename>", methods=["GET"])
+@login_required
+def download_profile(filename):
+    if not is_admin() or not filename.endswith(('.prof', '.sql')):
+        abort(404)
+    return send_from_directory(app.config["PROFILE_DIR"], filename, as_attachment=True)
+
+@app.route("/admin/admission", methods=["GET"])
+@login_required
+def admission_metrics():
+    if not is_admin():
+        abort(404)
+    return {"enabled": app.config["ADMISSION_CONTROL"], "classes": admission_controller.metrics()}
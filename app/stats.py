@@ -0,0 +1,119 @@
+"""
+This module contains the learning statistics of the polyglotpivot project: accuracy,
+daily streaks and answers per day for every language of a user. The statistics are
+kept up to date by LanguageStats.record_answers whenever an answer is graded, so
+reading them costs O(languages + days shown). rebuild_stats and check_stats replay
+the practice log to repair or verify the counters.
+"""
+
+from __future__ import annotations
+
+from datetime import date, datetime, timedelta, timezone
+import sqlalchemy as sa
+from app import db
+from app.models import Practice, PracticeDay, Vocable, LearningDay, LanguageStats, language_registry
+from app.replicas import read_only
+
+
+@read_only
+def get_language_stats(user_id: int, today: date|None = None) -> list[dict]:
+    '''
+    Returns answers, accuracy and streaks of the user for every language he answered in.
+    '''
+    today = today or datetime.now(timezone.utc).date()
+    query = sa.select(LanguageStats).where(LanguageStats.user_id == user_id).order_by(LanguageStats.language_id)
+    return [{'language': language_registry.get(stats.language_id).name,
+             'iso': language_registry.get(stats.language_id).iso,
+             'answers': stats.answers,
+             'correct': stats.correct,
+             'accuracy': stats.accuracy,
+             'current_streak': stats.streak_on(today),
+             'longest_streak': stats.longest_streak} for stats in db.session.scalars(query)]
+
+
+@read_only
+def get_daily_activity(user_id: int, days: int, today: date|None = None) -> list[dict]:
+    '''
+    Returns the number of answers and correct answers of the user (all languages) for
+    each of the last days, including days without answers.
+    '''
+    today = today or datetime.now(timezone.utc).date()
+    first_day = today - timedelta(days=days - 1)
+    query = sa.select(LearningDay.day, sa.func.sum(LearningDay.answers), sa.func.sum(LearningDay.correct))\
+        .where(LearningDay.user_id == user_id, LearningDay.day >= first_day, LearningDay.day <= today)\
+        .group_by(LearningDay.day)
+    activity = {day: (answers, correct) for day, answers, correct in db.session.execute(query)}
+    return [{'day': day.isoformat(),
+             'answers': activity.get(day, (0, 0))[0],
+             'correct': activity.get(day, (0, 0))[1]}
+            for day in (first_day + timedelta(days=i) for i in range(days))]
+
+
+def compute_stats(batch_size: int) -> tuple[dict, dict]:
+    '''
+    Replays the practice log (Practice and the compacted PracticeDay entries) in chunks
+    of batch_size rows. Returns the learning days {(user_id, language_id, day): [answers, correct]}
+    and the language stats {(user_id, language_id): LanguageStats} it results in.
+    '''
+    learning_days: dict[tuple, list[int]] = {}
+    practices = sa.select(Practice.id, Practice.timestamp, Practice.iscorrect, Practice.language_id, Vocable.user_id)\
+        .join(Vocable, Vocable.id == Practice.vocable_id).order_by(Practice.id).limit(batch_size)
+    last_id = 0
+    while rows := db.session.execute(practices.where(Practice.id > last_id)).all():
+        for row in rows:
+            counts = learning_days.setdefault((row.user_id, row.language_id, row.timestamp.date()), [0, 0])
+            counts[0] += 1
+            counts[1] += int(row.iscorrect)
+        last_id = rows[-1].id
+    practice_days = sa.select(PracticeDay.id, PracticeDay.user_id, PracticeDay.language_id, PracticeDay.day,
+                              PracticeDay.correct, PracticeDay.incorrect).order_by(PracticeDay.id).limit(batch_size)
+    last_id = 0
+    while rows := db.session.execute(practice_days.where(PracticeDay.id > last_id)).all():
+        for row in rows:
+            counts = learning_days.setdefault((row.user_id, row.language_id, row.day), [0, 0])
+            counts[0] += row.correct + row.incorrect
+            counts[1] += row.correct
+        last_id = rows[-1].id
+
+    language_stats: dict[tuple, LanguageStats] = {}
+    for (user_id, language_id, day), (answers, correct) in sorted(learning_days.items()):
+        stats = language_stats.setdefault((user_id, language_id), LanguageStats(
+            user_id=user_id, language_id=language_id, answers=0, correct=0, current_streak=0, longest_streak=0))
+        stats.answers += answers
+        stats.correct += correct
+        stats.add_day(day)
+    return learning_days, language_stats
+
+
+def rebuild_stats(batch_size: int) -> None:
+    '''
+    Replaces all learning statistics with the statistics computed from the practice log.
+    '''
+    learning_days, language_stats = compute_stats(batch_size)
+    db.session.execute(sa.delete(LearningDay))
+    db.session.execute(sa.delete(LanguageStats))
+    db.session.add_all([LearningDay(user_id=user_id, language_id=language_id, day=day, answers=answers, correct=correct)
+                        for (user_id, language_id, day), (answers, correct) in learning_days.items()])
+    db.session.add_all(language_stats.values())
+    db.session.commit()
+
+
+def check_stats(batch_size: int) -> list[str]:
+    '''
+    Compares the learning statistics with the statistics computed from the practice log.
+    Returns a description of every difference.
+    '''
+    learning_days, language_stats = compute_stats(batch_size)
+    stored_days = {(d.user_id, d.language_id, d.day): [d.answers, d.correct]
+                   for d in db.session.scalars(sa.select(LearningDay))}
+    differences = [f'learning day {key}: stored {stored_days.get(key)}, expected {learning_days.get(key)}'
+                   for key in sorted(stored_days.keys() | learning_days.keys())
+                   if stored_days.get(key) != learning_days.get(key)]
+
+    def values(stats):
+        return stats and (stats.answers, stats.correct, stats.current_streak, stats.longest_streak, stats.last_day)
+    stored_stats = {(s.user_id, s.language_id): s for s in db.session.scalars(sa.select(LanguageStats))}
+    differences += [f'language stats {key}: stored {values(stored_stats.get(key))}, expected {values(language_stats.get(key))}'
+                    for key in sorted(stored_stats.keys() | language_stats.keys())
+                    if values(stored_stats.get(key)) != values(language_stats.get(key))]
+    return differences
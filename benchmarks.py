@@ -0,0 +1,289 @@
+"""
+Benchmarks of the polyglotpivot project. They run against a temporary sqlite
+database file. Run all benchmarks with
+
+    python benchmarks.py
+
+or only some of them with e.g. python benchmarks.py vocabulary
+"""
+
+import os
+import tempfile
+# bench_async passes the database of the benchmark to the served app with BENCHMARK_DATABASE_URL
+os.environ['DATABASE_URL'] = os.environ.get('BENCHMARK_DATABASE_URL') or \
+    'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+
+import sys
+import time
+import timeit
+import itertools
+import statistics
+import threading
+import socket
+import sqlite3
+import subprocess
+import http.cookiejar
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import sqlalchemy as sa
+from flask import render_template
+from flask_login import login_user
+from app import app, db
+from app.models import User, Vocable, Language, Session, language_registry
+from app.cache import fragment_cache
+from app.forms import EmptyForm
+from app.async_db import async_db
+from app.admission import admission_controller
+from config import Config
+
+# the row template before rendering was moved to the vocable_row macro
+LEGACY_ROW = """<tr>
+{% for language in current_user.languages %}
+    <td>
+        {{ vocable[language.iso] }}<br>
+        {% for i in range(vocable[language.iso + "_lvl"]) %}
+            <span class="dot"></span>
+        {% endfor %}
+
+    </td>
+{% endfor %}
+    <td>
+        <a href="{{ url_for('edit_vocable', vocable_id=vocable.id) }}"><span class="badge badge-primary">Edit</span></a>
+    </td>
+</tr>"""
+
+LEGACY_TABLE = """<table>{% for vocable in vocables %}{% include legacy_row %}{% endfor %}</table>"""
+
+
+def seed(number_vocables: int) -> User:
+    '''
+    Creates a fresh database with one user that studies all languages and has
+    number_vocables vocables at mixed levels.
+    '''
+    db.drop_all()
+    db.create_all()
+    language_registry.clear()
+    db.session.add_all([Language(iso=iso, name=name) for iso, name in Config.LANGUAGES.items()])
+    user = User(username='Benchmark', email='benchmark@example.com')
+    user.session = Session()
+    db.session.add(user)
+    db.session.commit()
+    user.set_languages(list(Config.LANGUAGES.values()))
+    vocables = []
+    for i in range(number_vocables):
+        vocable = Vocable(user_id=user.id, **{iso: f'{iso}-{i}' for iso in Config.LANGUAGES})
+        for iso in Config.LANGUAGES:
+            setattr(vocable, iso + '_lvl', i % (Vocable.MAX_LVL + 1))
+        vocables.append(vocable)
+    db.session.add_all(vocables)
+    db.session.commit()
+    return user
+
+
+def bench_vocabulary(repeat: int = 5) -> None:
+    '''
+    Render time of the vocabulary page for 25, 250 and 2,500 rows. It compares the
+    legacy include per row with the vocable_row macro on a cold and on a warm
+    fragment cache.
+    '''
+    print('vocabulary page render time [ms]')
+    print(f'{"rows":>6} {"legacy":>10} {"cold":>10} {"warm":>10}')
+    for rows in (25, 250, 2500):
+        with app.app_context():
+            user = seed(rows)
+            with app.test_request_context('/vocabulary'):
+                login_user(user)
+                vocables = db.session.scalars(db.select(Vocable)).all()
+                legacy_table = app.jinja_env.from_string(LEGACY_TABLE)
+                legacy_row = app.jinja_env.from_string(LEGACY_ROW)
+
+                def legacy():
+                    legacy_table.render(vocables=vocables, legacy_row=legacy_row,
+                                        current_user=user)
+
+                def cold():
+                    fragment_cache.clear()
+                    render_template('vocabulary.html', vocables=vocables, form=EmptyForm())
+
+                def warm():
+                    render_template('vocabulary.html', vocables=vocables, form=EmptyForm())
+
+                warm()
+                timings = [min(timeit.repeat(f, number=1, repeat=repeat)) * 1000
+                           for f in (legacy, cold, warm)]
+        print(f'{rows:>6} ' + ' '.join(f'{t:>10.2f}' for t in timings))
+
+
+class SlowCursor(sqlite3.Cursor):
+    '''
+    Waits BENCHMARK_LATENCY_MS before every statement, like the network round trip to MySQL.
+    The wait happens in the thread of the driver, for aiosqlite not on the event loop.
+    '''
+    latency = float(os.environ.get('BENCHMARK_LATENCY_MS') or 0) / 1000
+
+    def execute(self, *args):
+        time.sleep(self.latency)
+        return super().execute(*args)
+
+
+class SlowConnection(sqlite3.Connection):
+
+    def cursor(self, factory=SlowCursor):
+        return super().cursor(factory)
+
+
+def use_slow_connections(engine: sa.Engine) -> None:
+    @sa.event.listens_for(engine, 'do_connect')
+    def connect_slowly(dialect, connection_record, cargs, cparams):
+        cparams['factory'] = SlowConnection
+
+
+def served_app():
+    '''
+    The app with slow database connections as served in bench_async:
+    gunicorn 'benchmarks:served_app()'
+    '''
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        use_slow_connections(db.engine)
+    use_slow_connections(async_db.engine.sync_engine)
+    return app
+
+
+def bench_async(latency_ms: int = 5, requests: int = 400, clients: int = 32) -> None:
+    '''
+    Concurrent-connection capacity of one gunicorn worker for the vocabulary listing
+    (/api/vocabulary), while every statement waits latency_ms in the database. clients
+    connections send requests at the same time. The sync worker serves one request at a
+    time like the sync stack; the AsyncSession round trips of all threads of a gthread
+    worker share the event loop and the connection pool of the worker.
+    '''
+    with app.app_context():
+        user = seed(250)
+        user.set_password('benchmark')
+        db.session.commit()
+        db.session.remove()
+    env = dict(os.environ, BENCHMARK_DATABASE_URL=app.config['SQLALCHEMY_DATABASE_URI'],
+               BENCHMARK_LATENCY_MS=str(latency_ms))
+
+    def serve(worker_class: str, threads: int) -> tuple[subprocess.Popen, str]:
+        with socket.socket() as free:
+            free.bind(('127.0.0.1', 0))
+            url = 'http://127.0.0.1:%d' % free.getsockname()[1]
+        server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--workers', '1', '--worker-class', worker_class,
+                                   '--threads', str(threads), '--bind', url[len('http://'):],
+                                   '--log-level', 'warning', 'benchmarks:served_app()'], env=env)
+        for _ in range(300):
+            try:
+                urllib.request.urlopen(url + '/login').close()
+                return server, url
+            except OSError:
+                time.sleep(0.1)
+        server.terminate()
+        raise RuntimeError(f'gunicorn did not start on {url}')
+
+    def measure(url: str) -> tuple[float, float]:
+        cookies = http.cookiejar.CookieJar()
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cookies))
+        opener.open(url + '/login', data=b'username=Benchmark&password=benchmark').close()
+        cookie = '; '.join(f'{c.name}={c.value}' for c in cookies)
+
+        def get(_) -> float:
+            started = time.perf_counter()
+            with urllib.request.urlopen(urllib.request.Request(url + '/api/vocabulary',
+                                                               headers={'Cookie': cookie})) as response:
+                response.read()
+            return time.perf_counter() - started
+
+        with ThreadPoolExecutor(clients) as pool:
+            list(pool.map(get, range(clients)))  # warm up
+            started = time.perf_counter()
+            latencies = sorted(pool.map(get, range(requests)))
+            rate = requests / (time.perf_counter() - started)
+        return rate, latencies[int(0.95 * (len(latencies) - 1))] * 1000
+
+    print(f'vocabulary listing with {latency_ms} ms database latency, {clients} clients and one worker')
+    print(f'{"worker":>8} {"threads":>8} {"req/s":>10} {"p95 [ms]":>10}')
+    for worker_class, threads in (('sync', 1), ('gthread', 8), ('gthread', 32)):
+        server, url = serve(worker_class, threads)
+        try:
+            rate, p95 = measure(url)
+        finally:
+            server.terminate()
+            server.wait()
+        print(f'{worker_class:>8} {threads:>8} {rate:>10.1f} {p95:>10.1f}')
+
+
+def bench_admission(workers: int = 4, flood: int = 200, practices: int = 40) -> None:
+    '''
+    Latency of practice round trips (new vocable and answer) on a worker with a fixed
+    pool of threads while a flood of login attempts (password hashing) is running, with
+    and without admission control. The latency includes the wait for a free thread.
+    '''
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        seed(0)
+        # every thread practices as another user, like the requests of different learners
+        for i in range(workers):
+            user = User(username=f'Learner{i}', email=f'learner{i}@example.com')
+            user.set_password('benchmark')
+            user.session = Session()
+            db.session.add(user)
+            db.session.commit()
+            user.set_languages(['English', 'German'])
+            db.session.add_all([Vocable(user_id=user.id, en=f'en-{j}', de=f'de-{j}') for j in range(50)])
+            db.session.commit()
+        db.session.remove()
+    local = threading.local()
+    learners = itertools.count()
+
+    def client(logged_in: bool):
+        attribute = 'user_client' if logged_in else 'anonymous_client'
+        if not hasattr(local, attribute):
+            setattr(local, attribute, app.test_client())
+            if logged_in:
+                local.user_client.post('/login', data={'username': f'Learner{next(learners) % workers}', 
+                                                       'password': 'benchmark'})
+                local.user_client.post('/config_practice', data={'source_language': 'English', 
+                                                                 'target_language': 'German'})
+        return getattr(local, attribute)
+
+    def login_attempt():
+        client(False).post('/login', data={'username': 'Learner0', 'password': 'wrong'})
+
+    def practice_round_trip(submitted):
+        client(True).get('/api/new_vocable')
+        client(True).post('/api/practice', json={'answer': 'de-0'})
+        return time.perf_counter() - submitted
+
+    def run(with_flood: bool) -> list[float]:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            barrier = threading.Barrier(workers)
+            list(pool.map(lambda _: (client(True), client(False), barrier.wait()), range(workers)))
+            futures = []
+            for i in range(practices):
+                if with_flood:
+                    for _ in range(flood // practices):
+                        pool.submit(login_attempt)
+                futures.append(pool.submit(practice_round_trip, time.perf_counter()))
+                time.sleep(0.005)
+            return [future.result() * 1000 for future in futures]
+
+    print(f'practice round trip latency with {workers} threads [ms]')
+    print(f'{"scenario":>22} {"p50":>10} {"p95":>10} {"max":>10}')
+    for name, admission, with_flood in (('no flood', False, False), ('flood', False, True),
+                                        ('flood with admission', True, True)):
+        app.config.update(ADMISSION_CONTROL=admission, ADMISSION_USER_BURST=10 ** 6)
+        admission_controller.configure(app.config)
+        latencies = sorted(run(with_flood))
+        print(f'{name:>22} {statistics.median(latencies):>10.1f} '
+              f'{latencies[int(0.95 * (len(latencies) - 1))]:>10.1f} {latencies[-1]:>10.1f}')
+    print('admission metrics:', admission_controller.metrics()['expensive'])
+
+
+BENCHMARKS = {'vocabulary': bench_vocabulary, 'async': bench_async, 'admission': bench_admission}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
+        print()
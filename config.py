@@ -7,14 +7,60 @@ class Config:
     SECRET_KEY = os.environ.get("SECRET_KEY") or '5ce75b535d368562838b7f6cac05b344'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'mysql+pymysql://polyglotpivot:@localhost:3306/polyglotpivot'
+    # defaults to SQLALCHEMY_DATABASE_URI with the async driver (aiomysql or aiosqlite)
+    ASYNC_DATABASE_URI = os.environ.get('ASYNC_DATABASE_URL')
+    ASYNC_POOL_SIZE = int(os.environ.get('ASYNC_POOL_SIZE') or 10)  # connections of the event loop of a worker
+    # comma separated list of read replicas of the database
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if uri]
+    REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS') or 5)
+    REPLICA_HEALTH_CHECK_SECONDS = int(os.environ.get('REPLICA_HEALTH_CHECK_SECONDS') or 10)
+    REPLICA_RETRY_SECONDS = int(os.environ.get('REPLICA_RETRY_SECONDS') or 30)
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['polyglotpivot@gmail.com']
+    PROFILING = os.environ.get('PROFILING') is not None
+    PROFILE_SAMPLE_RATE = int(os.environ.get('PROFILE_SAMPLE_RATE') or 0)  # profile 1 in N requests, 0 = only on demand
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(basedir, 'profiles')
+    PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP') or 100)
+    ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL') is not None
+    ADMISSION_DEFAULT_LIMIT = int(os.environ.get('ADMISSION_DEFAULT_LIMIT') or 16)
+    ADMISSION_DEFAULT_WAIT = float(os.environ.get('ADMISSION_DEFAULT_WAIT') or 1.0)
+    ADMISSION_EXPENSIVE_LIMIT = int(os.environ.get('ADMISSION_EXPENSIVE_LIMIT') or 2)
+    ADMISSION_EXPENSIVE_WAIT = float(os.environ.get('ADMISSION_EXPENSIVE_WAIT') or 0)
+    ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER') or 2)
+    ADMISSION_USER_RATE = float(os.environ.get('ADMISSION_USER_RATE') or 0.2)  # expensive requests per second
+    ADMISSION_USER_BURST = int(os.environ.get('ADMISSION_USER_BURST') or 10)
+    ADMISSION_DEEP_PAGE = int(os.environ.get('ADMISSION_DEEP_PAGE') or 20)
+    # number of reverse proxies in front of the app whose X-Forwarded-For and X-Forwarded-Proto are trusted
+    TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES') or 0)
+    LOG_DIR = os.environ.get('LOG_DIR') or 'logs'
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 50 * 1024 * 1024)
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT') or 10)
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE') or 10000)
+    LOG_MAIL_INTERVAL = int(os.environ.get('LOG_MAIL_INTERVAL') or 300)  # seconds between error emails
     POSTS_PER_PAGE = 5
     VOCABLES_PER_PAGE = 25
+    TEMPLATE_BYTECODE_CACHE_DIR = os.environ.get('TEMPLATE_BYTECODE_CACHE_DIR') or \
+        os.path.join(basedir, '.jinja_cache')
+    PRACTICE_RETENTION_DAYS = int(os.environ.get('PRACTICE_RETENTION_DAYS') or 90)
+    PRACTICE_COMPACTION_BATCH_SIZE = int(os.environ.get('PRACTICE_COMPACTION_BATCH_SIZE') or 5000)
+    PRACTICE_ARCHIVE_DIR = os.environ.get('PRACTICE_ARCHIVE_DIR') or os.path.join(basedir, 'archive')
+    # seconds between two compactions inside the app, 0 disables the scheduled compaction
+    PRACTICE_COMPACTION_INTERVAL = int(os.environ.get('PRACTICE_COMPACTION_INTERVAL') or 0)
+    STATS_DAYS = 30  # days shown in the activity chart of the profile page
+    STATS_REBUILD_BATCH_SIZE = int(os.environ.get('STATS_REBUILD_BATCH_SIZE') or 10000)
+    PURGE_BATCH_SIZE = int(os.environ.get('PURGE_BATCH_SIZE') or 1000)
+    # sqlite:///<file> for the workers of one machine, redis://<host> for several machines
+    INVALIDATION_BUS_URL = os.environ.get('INVALIDATION_BUS_URL') or \
+        'sqlite:///' + os.path.join(basedir, '.invalidation.db')
+    INVALIDATION_POLL_INTERVAL = float(os.environ.get('INVALIDATION_POLL_INTERVAL') or 0.5)
+    PRACTICE_PACK_SIZE = int(os.environ.get('PRACTICE_PACK_SIZE') or 50)
+    PRACTICE_PACK_MAX_SIZE = int(os.environ.get('PRACTICE_PACK_MAX_SIZE') or 200)
+    PRACTICE_SYNC_MAX_RESULTS = int(os.environ.get('PRACTICE_SYNC_MAX_RESULTS') or 500)
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 10000)
     CONSENT_FULL_TEMPLATE= 'consent.html'
     CONSENT_BANNER_TEMPLATE = 'consent_banner.html'
     LANGUAGES = {'de':'German',
@@ -7,3 +7,8 @@ for env_file in ('.env', '.flaskenv'):
     env = os.path.join(os.getcwd(), env_file)
     if os.path.exists(env):
         load_dotenv(env)
+
+
+# With GUNICORN_THREADS > 1 gunicorn uses threaded (gthread) workers. The AsyncSession round
+# trips of all threads of a worker share the event loop and the connection pool of app.async_db.
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
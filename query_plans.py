@@ -0,0 +1,178 @@
+"""
+Query plan checks of the polyglotpivot project. The hot queries are explained on a
+database with representative data (EXPLAIN QUERY PLAN on sqlite, EXPLAIN on MySQL if
+QUERY_PLAN_MYSQL_URL is set). A plan fails if it scans a table without an index or
+sorts in a temporary b-tree / filesort that is not expected for the query. The plans
+and timings are written to QUERY_PLAN_REPORT (default: a temporary file).
+
+    python query_plans.py
+
+The checks also run as part of tests.py.
+"""
+
+import os
+import re
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+from typing import NamedTuple
+import sqlalchemy as sa
+from app import db
+from app.models import User, Vocable, Practice, PracticeDay, Post, Language, LanguageRecord
+from app.async_db import get_query_of_vocables_page
+from config import Config
+
+
+class HotQuery(NamedTuple):
+    name: str
+    statement: sa.Select
+    allowed_sorts: frozenset[str]  # e.g. {'ORDER BY'} if the sort is inherent to the query
+
+
+class Plan(NamedTuple):
+    query: HotQuery
+    sql: str
+    plan: list[str]
+    milliseconds: float
+    violations: list[str]
+
+
+def seed_plan_data(engine: sa.Engine, users: int = 20, vocables_per_user: int = 200,
+                   practices_per_vocable: int = 5) -> None:
+    '''
+    Creates all tables and fills them with users that have vocables, practices,
+    compacted practice days and posts.
+    '''
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    start = datetime(2024, 1, 1)
+    languages = list(Config.LANGUAGES.items())
+    with engine.begin() as connection:
+        connection.execute(sa.insert(Language), [{'id': i + 1, 'iso': iso, 'name': name}
+                                                 for i, (iso, name) in enumerate(languages)])
+        connection.execute(sa.insert(User), [{'id': u, 'username': f'user{u}', 'email': f'user{u}@example.com'}
+                                             for u in range(1, users + 1)])
+        connection.execute(sa.insert(Vocable), [
+            {'id': v, 'user_id': (v - 1) // vocables_per_user + 1,
+             **{iso: f'{iso}-{v}' for iso, _ in languages},
+             **{iso + '_lvl': v % (Vocable.MAX_LVL + 1) for iso, _ in languages}}
+            for v in range(1, users * vocables_per_user + 1)])
+        connection.execute(sa.insert(Practice), [
+            {'vocable_id': v, 'language_id': p % len(languages) + 1, 'iscorrect': p % 3 != 0,
+             'timestamp': start + timedelta(minutes=v * practices_per_vocable + p)}
+            for v in range(1, users * vocables_per_user + 1) for p in range(practices_per_vocable)])
+        connection.execute(sa.insert(PracticeDay), [
+            {'vocable_id': v, 'user_id': (v - 1) // vocables_per_user + 1, 'language_id': 1,
+             'day': (start - timedelta(days=1)).date(), 'correct': 1, 'incorrect': 1,
+             'latest_timestamp': start - timedelta(days=1)}
+            for v in range(1, users * vocables_per_user + 1, 2)])
+        connection.execute(sa.insert(Post), [{'body': f'post {p}', 'user_id': p % users + 1,
+                                              'timestamp': start + timedelta(hours=p)} for p in range(users * 25)])
+    with engine.begin() as connection:
+        if engine.dialect.name == 'sqlite':
+            connection.exec_driver_sql('ANALYZE')
+        elif engine.dialect.name == 'mysql':
+            connection.exec_driver_sql('ANALYZE TABLE ' + ', '.join(f'`{table}`' for table in db.metadata.tables))
+
+
+def hot_queries(user_id: int = 2) -> list[HotQuery]:
+    user = User(id=user_id)
+    source, target = LanguageRecord(2, 'en', 'English'), LanguageRecord(1, 'de', 'German')
+    return [
+        # the latest timestamp is looked up per vocable of the user, the vocables are ordered by it
+        HotQuery('due vocable', user.get_query_of_vocables_with_latest_timestamp(source, target).limit(1),
+                 frozenset({'ORDER BY'})),
+        HotQuery('random vocable', user.get_query_of_random_vocable(source, target).limit(1),
+                 frozenset({'ORDER BY'})),
+        # at most MAX_LVL + 1 groups of the vocables of one user
+        HotQuery('words per level', user.get_query_of_words_per_level(target), frozenset({'GROUP BY'})),
+        HotQuery('vocabulary page', get_query_of_vocables_page(user_id, 3, 25), frozenset()),
+        HotQuery('feed', Post.get_query_of_feed().limit(25).offset(25), frozenset()),
+    ]
+
+
+def explain_sqlite(connection: sa.Connection, sql: str) -> tuple[list[str], list[str]]:
+    '''
+    Returns the plan lines and the violations of the plan.
+    '''
+    plan, violations = [], []
+    for _, _, _, detail in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql):
+        plan.append(detail)
+        scan = re.fullmatch(r'SCAN (\w+)', detail)
+        if scan and scan.group(1) in db.metadata.tables:
+            violations.append(f'full table scan of {scan.group(1)}')
+        sort = re.fullmatch(r'USE TEMP B-TREE FOR (?:RIGHT PART OF |LAST TERM OF )?(.+)', detail)
+        if sort:
+            violations.append(sort.group(1))
+    return plan, violations
+
+
+def explain_mysql(connection: sa.Connection, sql: str) -> tuple[list[str], list[str]]:
+    plan, violations = [], []
+    for row in connection.exec_driver_sql('EXPLAIN ' + sql).mappings():
+        plan.append(f"{row['table']}: type={row['type']} key={row['key']} rows={row['rows']} extra={row['Extra']}")
+        if row['type'] == 'ALL' and row['table'] in db.metadata.tables:
+            violations.append(f"full table scan of {row['table']}")
+        if 'Using temporary' in (row['Extra'] or ''):
+            violations.append('GROUP BY')
+        if 'Using filesort' in (row['Extra'] or ''):
+            violations.append('ORDER BY')
+    return plan, violations
+
+
+def check_plans(engine: sa.Engine, repeat: int = 5) -> list[Plan]:
+    '''
+    Explains and times every hot query. Sorts listed in allowed_sorts of the query
+    are not reported as violations.
+    '''
+    explain = explain_mysql if engine.dialect.name == 'mysql' else explain_sqlite
+    plans = []
+    with engine.connect() as connection:
+        for query in hot_queries():
+            sql = str(query.statement.compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True}))
+            plan, violations = explain(connection, sql)
+            milliseconds = min(timeit.repeat(lambda: connection.execute(query.statement).all(),
+                                             number=1, repeat=repeat)) * 1000
+            plans.append(Plan(query, sql, plan, milliseconds,
+                              sorted({v for v in violations if v not in query.allowed_sorts})))
+    return plans
+
+
+def write_report(plans: dict[str, list[Plan]], path: str) -> None:
+    with open(path, 'w') as report:
+        for database, database_plans in plans.items():
+            for plan in database_plans:
+                report.write(f'== {database}: {plan.query.name} ({plan.milliseconds:.2f} ms)\n')
+                report.write(plan.sql + '\n\n')
+                report.write(''.join(f'  {line}\n' for line in plan.plan))
+                if plan.violations:
+                    report.write(''.join(f'  FAILED: {violation}\n' for violation in plan.violations))
+                report.write('\n')
+
+
+def run() -> tuple[dict[str, list[Plan]], str]:
+    '''
+    Checks the plans on a temporary sqlite database and, if QUERY_PLAN_MYSQL_URL is set,
+    on MySQL. Returns the plans per database and the path of the report.
+    '''
+    engines = {'sqlite': sa.create_engine('sqlite:///' + os.path.join(tempfile.mkdtemp(), 'plans.db'))}
+    if os.environ.get('QUERY_PLAN_MYSQL_URL'):
+        engines['mysql'] = sa.create_engine(os.environ['QUERY_PLAN_MYSQL_URL'])
+    plans = {}
+    for database, engine in engines.items():
+        seed_plan_data(engine)
+        plans[database] = check_plans(engine)
+        engine.dispose()
+    path = os.environ.get('QUERY_PLAN_REPORT') or os.path.join(tempfile.mkdtemp(), 'query_plans.txt')
+    write_report(plans, path)
+    return plans, path
+
+
+if __name__ == '__main__':
+    plans, path = run()
+    failed = [f'{database}: {plan.query.name}: {", ".join(plan.violations)}'
+              for database, database_plans in plans.items() for plan in database_plans if plan.violations]
+    print('\n'.join(failed) or 'All query plans are fine.')
+    print(f'Report: {path}')
+    sys.exit(1 if failed else 0)
@@ -1,10 +1,72 @@
 import os 
-os.environ['DATABASE_URL'] = 'sqlite://'
+import tempfile
+# the AsyncSession needs a database file, an in-memory database is not shared between engines
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+os.environ['INVALIDATION_BUS_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'invalidation.db')
+os.environ['INVALIDATION_POLL_INTERVAL'] = '0'
+os.environ['PROFILING'] = '1'
+os.environ['PROFILE_DIR'] = tempfile.mkdtemp()
+os.environ['PRACTICE_ARCHIVE_DIR'] = tempfile.mkdtemp()
+os.environ['TRUSTED_PROXIES'] = '1'
 
+import fcntl
+import asyncio
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import multiprocessing
+import pstats
+import re
+import shutil
+import sys
+import threading
+import time
 import unittest
-from app import app, db 
-from app.models import User, Vocable, Practice, Language, Post 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from unittest import mock
+import sqlalchemy as sa
+from flask import g
+from app import app, db, invalidation_bus
+from app.models import (User, Vocable, Practice, PracticeDay, Language, Post, Session, LearningDay, LanguageStats,
+                        language_registry)
+from app.retention import compact_practices
+from app.stats import check_stats, rebuild_stats
+from app.cache import fragment_cache
+from app.replicas import replica_router, STICKY_KEY
+from app.invalidation import InvalidationBus, stream_id
+from app.logs import BoundedQueueHandler, JsonFormatter, RateLimitedSMTPHandler
+from app.profiling import RequestProfile, list_profiles, profile_coroutine
+from app.packs import apply_results, parse_results
+from app.admission import admission_controller, EXPENSIVE
+from app.async_db import async_db
 from config import Config
+import query_plans
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+@contextmanager
+def count_queries():
+    '''
+    Collects every SQL statement that is sent to the database inside the with block,
+    by the sync session and by the AsyncSession of app.async_db.
+    '''
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    with app.app_context():
+        engines = [db.engine, async_db.engine.sync_engine]
+    for engine in engines:
+        sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        for engine in engines:
+            sa.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
 
 
 
@@ -15,6 +77,7 @@ class UserModelCase(unittest.TestCase):
         self.app_context = app.app_context()
         self.app_context.push()
         db.create_all()
+        language_registry.clear()
     
     def tearDown(self):
         db.session.remove()
@@ -49,6 +112,792 @@ class UserModelCase(unittest.TestCase):
         db.session.commit()
         self.assertEqual(len(user.vocables),1)
 
+
+class LoggedInCase(unittest.TestCase):
+    '''
+    Fixture with the languages and the logged-in user Testuser, who practices English
+    to German and has one vocable. The app context is only pushed around database
+    work. Flask reuses a pushed app context for the requests of the test client, so g
+    (and the user that flask-login loaded) would be shared between the requests.
+    '''
+
+    def setUp(self):
+        with app.app_context():
+            db.create_all()
+            language_registry.clear()
+            db.session.add_all([Language(iso=iso, name=name) for iso, name in Config.LANGUAGES.items()])
+            user = User(username='Testuser', email='testuser@example.com')
+            user.set_password('mypassword')
+            user.session = Session()
+            db.session.add(user)
+            db.session.commit()
+            user.set_languages(['English', 'German'])
+            user.vocables.append(Vocable(en='hello', de='hallo'))
+            db.session.commit()
+        self.client = app.test_client()
+        self.client.post('/login', data={'username': 'Testuser', 'password': 'mypassword'})
+        self.client.post('/config_practice', data={'source_language': 'English', 
+                                                   'target_language': 'German'})
+
+    def tearDown(self):
+        with app.app_context():
+            db.drop_all()
+
+
+class PracticeCase(LoggedInCase):
+
+    def practice_round_trip(self):
+        self.client.get('/new_vocable')
+        return self.client.post('/practice', data={'your_answer': 'hallo', 'submit': True})
+
+    def test_set_languages(self):
+        with app.app_context():
+            user = db.session.get(User, 1)
+            self.assertEqual([l.name for l in user.languages], ['German', 'English'])
+            user.set_languages(['Dutch'])
+            self.assertEqual([l.iso for l in user.languages], ['nl'])
+            user.set_languages(['Dutch', 'French', 'Dutch'])
+            self.assertEqual(sorted(l.iso for l in user.get_languages()), ['fr', 'nl'])
+
+    def test_language_registry_lookups(self):
+        with app.app_context():
+            english = language_registry.by_iso('en')
+            self.assertIs(language_registry.by_name('English'), english)
+            self.assertIs(language_registry.get(str(english.id)), english)
+            self.assertIsNone(language_registry.get(None))
+            db.session.add(Language(iso='sv', name='Swedish'))
+            db.session.commit()
+            self.assertEqual(language_registry.by_iso('sv').name, 'Swedish')
+
+    def test_practice_round_trip_without_language_queries(self):
+        # the legacy views issued four language lookups per round trip 
+        # (two in new_vocable and two in practice)
+        language_registry.clear()
+        with count_queries() as cold:
+            self.practice_round_trip()
+        with count_queries() as warm:
+            response = self.practice_round_trip()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Your answer is correct!', response.data)
+        # a cold worker loads the registry once, afterwards no language query is left
+        self.assertEqual(len([s for s in cold if re.search(r'\bFROM language\b', s)]), 1)
+        self.assertEqual(len([s for s in warm if re.search(r'\bFROM language\b', s)]), 0)
+
+    def test_pages_without_language_queries(self):
+        # the languages of the user are resolved through the registry, not the languages relationship
+        for url in ['/index', '/edit_profile', '/vocabulary', '/add_vocable', '/edit_vocable/1', '/config_practice']:
+            with count_queries() as statements:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertEqual([s for s in statements if re.search(r'\bFROM language\b', s)], [], url)
+        self.assertIn(b'<th>English</th>', self.client.get('/vocabulary').data)
+
+    def test_vocabulary_rows_are_cached_per_version(self):
+        fragment_cache.clear()
+        response = self.client.get('/vocabulary')
+        self.assertIn(b'hallo', response.data)
+        self.assertEqual(len(fragment_cache), 1)
+        with app.app_context():
+            self.assertEqual(db.session.get(Vocable, 1).version_id, 1)
+        self.practice_round_trip()
+        with app.app_context():
+            self.assertEqual(db.session.get(Vocable, 1).version_id, 2)
+        response = self.client.get('/vocabulary')
+        self.assertEqual(response.data.count(b'<span class="dot"></span>'), 1)
+        self.assertEqual(len(fragment_cache), 2)
+
+    def test_concurrent_updates_of_a_vocable_do_not_conflict(self):
+        with app.app_context(), sa.orm.Session(db.engine) as other_tab:
+            vocable = db.session.get(Vocable, 1)
+            other_tab.get(Vocable, 1).de_lvl = 1
+            other_tab.commit()
+            vocable.de = 'hallo!'
+            db.session.commit()
+            self.assertEqual((vocable.de, vocable.de_lvl, vocable.version_id), ('hallo!', 1, 3))
+
+    def add_other_user(self) -> int:
+        '''
+        Adds the user Otheruser (password otherpassword) with one vocable and returns
+        the id of the vocable.
+        '''
+        with app.app_context():
+            other = User(username='Otheruser', email='otheruser@example.com')
+            other.set_password('otherpassword')
+            db.session.add(other)
+            db.session.commit()
+            other.vocables.append(Vocable(en='bye', de='tschüss'))
+            db.session.commit()
+            return other.vocables[0].id
+
+    def test_clients_do_not_share_the_loaded_user(self):
+        other_vocable_id = self.add_other_user()
+        other_client = app.test_client()
+        other_client.post('/login', data={'username': 'Otheruser', 'password': 'otherpassword'})
+        for client, vocable_id in ((self.client, 1), (other_client, other_vocable_id), (self.client, 1)):
+            vocables = client.get('/api/vocabulary').json['vocables']
+            self.assertEqual([vocable['id'] for vocable in vocables], [vocable_id])
+
+    def test_bulk_delete_only_deletes_own_vocables(self):
+        other_vocable_id = self.add_other_user()
+        self.practice_round_trip()
+        with app.app_context():
+            user = db.session.get(User, 1)
+            user.vocables.append(Vocable(en='house', de='Haus'))
+            db.session.commit()
+            ids = [v.id for v in user.vocables] + [other_vocable_id]
+        with count_queries() as statements:
+            response = self.client.post('/delete_vocables', data={'vocable_ids': ids})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len([s for s in statements if s.startswith('DELETE')]), 1)
+        with app.app_context():
+            remaining = db.session.scalars(sa.select(Vocable.en)).all()
+            self.assertEqual(remaining, ['bye'])
+            self.assertEqual(db.session.scalar(sa.select(sa.func.count(Practice.id))), 0)
+
+    def test_purge_user(self):
+        other_vocable_id = self.add_other_user()
+        with app.app_context():
+            user = db.session.get(User, 1)
+            user.vocables.extend([Vocable(en=f'word{i}') for i in range(5)])
+            db.session.add(Post(body='hello', author=user))
+            db.session.commit()
+        self.practice_round_trip()
+        with app.app_context():
+            db.session.get(User, 1).purge(batch_size=2)
+            self.assertIsNone(db.session.get(User, 1))
+            self.assertEqual(db.session.scalars(sa.select(Vocable.id)).all(), [other_vocable_id])
+            self.assertEqual(db.session.scalar(sa.select(sa.func.count(Practice.id))), 0)
+            self.assertEqual(db.session.scalar(sa.select(sa.func.count(Post.id))), 0)
+            self.assertEqual(db.session.scalar(sa.select(sa.func.count(Session.user_id))), 0)
+
+    def test_api_practice_round_trip(self):
+        response = self.client.get('/api/new_vocable')
+        self.assertEqual(response.json['prompt'], 'hello')
+        response = self.client.post('/api/practice', json={'answer': 'hallo'})
+        self.assertEqual(response.json, {'vocable_id': 1, 'correct': True, 'answer': 'hallo', 'level': 1})
+        response = self.client.post('/api/practice', json={'answer': 'hello'})
+        self.assertFalse(response.json['correct'])
+        with app.app_context():
+            self.assertEqual(db.session.scalar(sa.select(sa.func.count(Practice.id))), 2)
+        response = self.client.get('/api/vocabulary')
+        self.assertEqual(response.json['vocables'][0]['de'], 'hallo')
+        self.assertFalse(response.json['has_next'])
+
+    def test_sync_database_work_stays_off_the_event_loop(self):
+        # a sync round trip in the loop thread would stall the AsyncSession work of all other requests
+        threads = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            threads.append(threading.current_thread().name)
+        with app.app_context():
+            engine = db.engine
+        language_registry.clear()
+        sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            for url in ['/vocabulary', '/new_vocable', '/practice', '/api/vocabulary', '/api/new_vocable']:
+                self.assertLess(self.client.get(url).status_code, 400, url)
+        finally:
+            sa.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertTrue(threads)
+        self.assertNotIn('async-db', threads)
+
+    def test_concurrent_requests_on_a_cold_worker(self):
+        async_db._pid = None  # like a new worker process: the loop and the engine do not exist yet
+        session_cookie = self.client.get_cookie('session').value
+        def new_vocable(_):
+            client = app.test_client()
+            client.set_cookie('session', session_cookie)
+            return client.get('/api/new_vocable').status_code
+        with ThreadPoolExecutor(8) as pool:
+            self.assertEqual(list(pool.map(new_vocable, range(8))), [200] * 8)
+
+    def test_compact_practices(self):
+        with app.app_context():
+            user = db.session.get(User, 1)
+            user.vocables.append(Vocable(en='house', de='Haus'))
+            db.session.commit()
+            old = datetime(2020, 1, 1, 12)
+            german, english = language_registry.by_iso('de'), language_registry.by_iso('en')
+            db.session.add_all([Practice(vocable_id=1, language_id=german.id, iscorrect=True, timestamp=old),
+                                Practice(vocable_id=1, language_id=german.id, iscorrect=False, timestamp=old + timedelta(hours=1)),
+                                Practice(vocable_id=1, language_id=german.id, iscorrect=True, timestamp=old + timedelta(days=1)),
+                                Practice(vocable_id=2, language_id=english.id, iscorrect=True, timestamp=old),
+                                Practice(vocable_id=2, language_id=german.id, iscorrect=True, timestamp=datetime.now())])
+            db.session.commit()
+            def latest():
+                return [(row[0].id, row[1]) for row in 
+                        db.session.execute(user.get_query_of_vocables_with_latest_timestamp(english, german))]
+            before = latest()
+            archive_dir = tempfile.mkdtemp()
+            self.assertEqual(compact_practices(30, 1, archive_dir), 4)
+            self.assertEqual(latest(), before)
+            self.assertTrue(db.session.get(Vocable, 1).check_if_studied())
+            self.assertEqual(db.session.scalar(sa.select(sa.func.count(Practice.id))), 1)
+            days = db.session.execute(sa.select(PracticeDay.vocable_id, PracticeDay.day, PracticeDay.correct, 
+                                                PracticeDay.incorrect).order_by(PracticeDay.id)).all()
+            self.assertEqual([tuple(day) for day in days], [(1, old.date(), 1, 1), (1, old.date() + timedelta(days=1), 1, 0),
+                                                           (2, old.date(), 1, 0)])
+            archived = []
+            for path in sorted(glob.glob(os.path.join(archive_dir, '*.ndjson.gz'))):
+                archived.extend(gzip.open(path).read().splitlines())
+            self.assertEqual(len(archived), 4)
+            self.assertEqual(compact_practices(30, 1, archive_dir), 0)
+
+    def test_compact_command_waits_for_the_lock(self):
+        with app.app_context():
+            db.session.add(Practice(vocable_id=1, language_id=language_registry.by_iso('de').id, iscorrect=True,
+                                    timestamp=datetime(2020, 1, 1)))
+            db.session.commit()
+        runner = app.test_cli_runner()
+        archive_dir = tempfile.mkdtemp()
+        # like the scheduled compaction thread of a worker
+        with open(os.path.join(app.config['PRACTICE_ARCHIVE_DIR'], '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            result = runner.invoke(args=['practice', 'compact', '--archive-dir', archive_dir])
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('Another process is compacting', result.output)
+        result = runner.invoke(args=['practice', 'compact', '--horizon-days', '30', '--archive-dir', archive_dir])
+        self.assertEqual((result.exit_code, result.output), (0, '1 practices were compacted.\n'))
+        self.assertEqual(len(glob.glob(os.path.join(archive_dir, '*.ndjson.gz'))), 1)
+
+    def test_learning_statistics(self):
+        self.practice_round_trip()
+        self.client.get('/api/new_vocable')
+        self.client.post('/api/practice', json={'answer': 'wrong'})
+        response = self.client.get('/api/stats?days=7')
+        self.assertEqual(response.json['languages'], [{'language': 'German', 'iso': 'de', 'answers': 2, 'correct': 1,
+                                                       'accuracy': 0.5, 'current_streak': 1, 'longest_streak': 1}])
+        self.assertEqual(len(response.json['activity']), 7)
+        self.assertEqual(response.json['activity'][-1]['answers'], 2)
+        response = self.client.get('/user/Testuser')
+        self.assertIn(b'50 %', response.data)
+        with app.app_context():
+            self.assertEqual(check_stats(1), [])
+
+    def test_streaks(self):
+        stats = LanguageStats(current_streak=0, longest_streak=0)
+        for day in (1, 2, 2, 3, 5, 6):
+            stats.add_day(date(2024, 1, day))
+        self.assertEqual((stats.current_streak, stats.longest_streak), (2, 3))
+        self.assertEqual(stats.streak_on(date(2024, 1, 7)), 2)
+        self.assertEqual(stats.streak_on(date(2024, 1, 8)), 0)
+
+    def test_answers_of_concurrent_sessions_are_counted(self):
+        with app.app_context(), sa.orm.Session(db.engine) as other_tab:
+            today = date(2024, 1, 1)
+            LanguageStats.record_answers(db.session, 1, 1, today, 1, 1)
+            db.session.commit()
+            self.assertEqual(db.session.scalar(sa.select(LearningDay)).answers, 1)  # loaded, then stale
+            LanguageStats.record_answers(other_tab, 1, 1, today, 0, 1)
+            other_tab.commit()
+            LanguageStats.record_answers(db.session, 1, 1, today, 1, 1)
+            db.session.commit()
+            day = db.session.scalar(sa.select(LearningDay))
+            stats = db.session.scalar(sa.select(LanguageStats))
+            self.assertEqual((day.answers, day.correct, stats.answers, stats.correct, stats.current_streak), (3, 2, 3, 2, 1))
+
+    def test_upsert_without_a_native_statement(self):
+        with app.app_context(), mock.patch.object(db.engine.dialect, 'name', 'mssql'):
+            today = date(2024, 1, 1)
+            LanguageStats.record_answers(db.session, 1, 1, today, 1, 1)
+            LanguageStats.record_answers(db.session, 1, 1, today, 0, 1)
+            db.session.commit()
+            day = db.session.scalar(sa.select(LearningDay))
+            stats = db.session.scalar(sa.select(LanguageStats))
+            self.assertEqual((day.answers, day.correct, stats.answers, stats.correct), (2, 1, 2, 1))
+
+    def test_rebuild_statistics(self):
+        self.practice_round_trip()
+        self.practice_round_trip()
+        with app.app_context():
+            compact_practices(-1, 1, tempfile.mkdtemp())
+            db.session.add(Practice(vocable_id=1, language_id=language_registry.by_iso('de').id, iscorrect=False,
+                                    timestamp=datetime(2020, 1, 1)))
+            db.session.execute(sa.update(LearningDay).values(answers=5))
+            db.session.commit()
+            self.assertEqual(len(check_stats(1)), 3)
+            rebuild_stats(1)
+            self.assertEqual(check_stats(1), [])
+            stats = db.session.scalar(sa.select(LanguageStats))
+            self.assertEqual((stats.answers, stats.correct, stats.longest_streak), (3, 2, 1))
+
+    def test_tagged_fragments_are_invalidated(self):
+        fragment_cache.clear()
+        fragment_cache.set('a', 1, tags=('user:1',))
+        fragment_cache.set('b', 2, tags=('user:2',))
+        fragment_cache.invalidate_tag('user:1')
+        self.assertIsNone(fragment_cache.get('a'))
+        self.assertEqual(fragment_cache.get('b'), 2)
+
+    def test_publish_in_other_process_drops_fragments(self):
+        fragment_cache.clear()
+        self.client.get('/vocabulary')
+        self.assertEqual(len(fragment_cache), 1)
+        process = multiprocessing.get_context('fork').Process(
+            target=publish_keys, args=(app.config['INVALIDATION_BUS_URL'], 'user:1', 1))
+        process.start()
+        process.join()
+        invalidation_bus.poll(force=True)
+        self.assertEqual(len(fragment_cache), 0)
+
+    def test_edit_vocable_drops_fragments(self):
+        fragment_cache.clear()
+        self.client.get('/vocabulary')
+        self.assertEqual(len(fragment_cache), 1)
+        self.client.post('/edit_vocable/1', data={'en': 'hi', 'de': 'hallo'})
+        self.assertEqual(len(fragment_cache), 0)
+
+    def test_requests_are_logged_as_json(self):
+        with self.assertLogs(app.logger, 'INFO') as logs:
+            response = self.client.get('/vocabulary', headers={'X-Request-ID': 'abc'})
+        self.assertEqual(response.headers['X-Request-ID'], 'abc')
+        line = json.loads(JsonFormatter().format(logs.records[-1]))
+        self.assertEqual((line['route'], line['status'], line['user_id']), ('/vocabulary', 200, 1))
+        self.assertGreater(line['sql_count'], 0)
+        self.assertIn('latency_ms', line)
+
+
+    def login_admin(self):
+        with app.app_context():
+            admin = User(username='Admin', email='admin@example.com')
+            admin.set_password('adminpassword')
+            db.session.add(admin)
+            db.session.commit()
+        self.assertEqual(app.test_cli_runner().invoke(args=['account', 'admin', 'Admin']).exit_code, 0)
+        self.client.get('/logout')
+        self.client.post('/login', data={'username': 'Admin', 'password': 'adminpassword'})
+
+    def test_admin_can_profile_a_request(self):
+        response = self.client.get('/vocabulary?profile=1')
+        self.assertNotIn('X-Profile-Name', response.headers)
+        self.assertEqual(self.client.get('/admin/profiles').status_code, 404)
+        # the email of an account is not verified, it grants no admin rights
+        self.client.get('/logout')
+        self.client.post('/register', data={'username': 'Mallory', 'email': app.config['ADMINS'][0],
+                                            'password': 'malloryword', 'confirm': 'malloryword'})
+        response = self.client.post('/login', data={'username': 'Mallory', 'password': 'malloryword'})
+        self.assertEqual(response.location, '/index')
+        self.assertEqual(self.client.get('/admin/profiles').status_code, 404)
+        self.assertEqual(self.client.get('/admin/admission').status_code, 404)
+        self.login_admin()
+        response = self.client.get('/vocabulary', headers={'X-Profile': '1'})
+        name = response.headers['X-Profile-Name']
+        # the AsyncSession work runs in the thread of the event loop, which has to be profiled as well
+        stats = pstats.Stats(os.path.join(app.config['PROFILE_DIR'], name + '.prof'))
+        self.assertIn('get_vocables_page', [function for _, _, function in stats.stats])
+        sql = self.client.get(f'/admin/profiles/{name}.sql')
+        self.assertIn(b'FROM vocable', sql.data)
+        sql.close()
+        self.assertIn(b'/vocabulary', self.client.get('/admin/profiles').data)
+
+    def test_profile_of_a_coroutine_leaves_out_other_tasks(self):
+        def spin_own():
+            return sum(range(1000))
+        def spin_other():
+            return sum(range(1000))
+        async def own():
+            await asyncio.sleep(0.01)  # the loop runs the other task meanwhile
+            return spin_own()
+        async def other():
+            return spin_other()
+        async def both(coroutine):
+            return await asyncio.gather(coroutine, other())
+        profile = RequestProfile()
+        with app.test_request_context():
+            g.profile = profile
+            self.assertEqual(asyncio.run(both(profile_coroutine(own()))), [499500, 499500])
+        functions = [function for _, _, function in pstats.Stats(*profile.profilers).stats]
+        self.assertIn('spin_own', functions)
+        self.assertNotIn('spin_other', functions)
+
+    def test_profiles_are_kept_in_a_ring(self):
+        self.login_admin()
+        app.config['PROFILE_KEEP'] = 2
+        try:
+            names = [self.client.get('/index?profile=1').headers['X-Profile-Name'] for _ in range(3)]
+        finally:
+            app.config['PROFILE_KEEP'] = Config.PROFILE_KEEP
+        self.assertEqual([p['name'] for p in list_profiles(app.config['PROFILE_DIR'])][:2], names[:0:-1])
+        self.assertFalse(os.path.exists(os.path.join(app.config['PROFILE_DIR'], names[0] + '.prof')))
+
+    def test_practice_pack(self):
+        response = self.client.get('/api/practice_pack?size=10')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        document = gzip.decompress(response.data)
+        self.assertEqual(hashlib.sha256(document).hexdigest(), response.headers['X-Pack-SHA256'])
+        pack = json.loads(document)
+        self.assertEqual((pack['source'], pack['target']), ('en', 'de'))
+        self.assertEqual(pack['vocables'], [[1, 1, 'hello', 'hallo', 0]])
+
+    def sync_batch(self, keys, vocable_id=1, gzipped=False):
+        batch = json.dumps({'version': 1, 'target': 'de', 'results': [
+            {'key': key, 'vocable_id': vocable_id, 'correct': True,
+             'timestamp': (datetime(2024, 1, 1) + timedelta(minutes=i)).isoformat()} for i, key in enumerate(keys)]})
+        if gzipped:
+            return self.client.post('/api/practice_sync', data=gzip.compress(batch.encode()),
+                                    headers={'Content-Encoding': 'gzip'}, content_type='application/json')
+        return self.client.post('/api/practice_sync', data=batch, content_type='application/json')
+
+    def test_practice_sync_is_idempotent(self):
+        other_vocable_id = self.add_other_user()
+        response = self.sync_batch(['a', 'b'], gzipped=True)
+        self.assertEqual(response.json, {'applied': 2, 'duplicates': 0, 'rejected': [], 'levels': {'1': 2}})
+        response = self.sync_batch(['a', 'b', 'c', 'c'])
+        self.assertEqual(response.json, {'applied': 1, 'duplicates': 3, 'rejected': [], 'levels': {'1': 3}})
+        response = self.sync_batch(['d'], vocable_id=other_vocable_id)
+        self.assertEqual(response.json['rejected'], ['d'])
+        with app.app_context():
+            self.assertEqual(db.session.scalar(sa.select(sa.func.count(Practice.id))), 3)
+            vocable = db.session.get(Vocable, 1)
+            self.assertEqual((vocable.de_lvl, vocable.version_id), (3, 3))
+            stats = db.session.scalar(sa.select(LanguageStats))
+            self.assertEqual((stats.answers, stats.correct, stats.current_streak), (3, 3, 1))
+        self.assertEqual(self.sync_batch(['e'] * 2 + ['x' * 65]).status_code, 400)
+
+    def test_practice_sync_rejects_bad_uploads(self):
+        body = gzip.compress(json.dumps({'version': 1, 'target': 'de', 'results': []}).encode())
+        for data in (body[:-10], body[:10] + b'\xff' * 20):  # truncated and corrupt
+            response = self.client.post('/api/practice_sync', data=data, headers={'Content-Encoding': 'gzip'},
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+        for target in (['de'], {'iso': 'de'}, 7, None):
+            response = self.client.post('/api/practice_sync', json={'version': 1, 'target': target, 'results': []})
+            self.assertEqual(response.status_code, 400, target)
+        self.assertEqual(self.client.post('/api/practice_sync', json=[]).status_code, 400)
+
+    def test_practice_sync_of_an_earlier_day_extends_the_streak(self):
+        self.practice_round_trip()
+        yesterday = datetime.now(timezone.utc) - timedelta(days=1)
+        batch = {'version': 1, 'target': 'de', 'results': [
+            {'key': 'a', 'vocable_id': 1, 'correct': True, 'timestamp': yesterday.isoformat()}]}
+        self.assertEqual(self.client.post('/api/practice_sync', json=batch).json['applied'], 1)
+        with app.app_context():
+            self.assertEqual(check_stats(1), [])
+            stats = db.session.scalar(sa.select(LanguageStats))
+            self.assertEqual((stats.answers, stats.current_streak, stats.longest_streak), (2, 2, 2))
+
+    def test_practice_sync_keys_are_unique_per_user(self):
+        other_vocable_id = self.add_other_user()
+        self.assertEqual(self.sync_batch(['1']).json['applied'], 1)
+        self.client.get('/logout')
+        self.client.post('/login', data={'username': 'Otheruser', 'password': 'otherpassword'})
+        response = self.sync_batch(['1'], vocable_id=other_vocable_id)
+        self.assertEqual((response.json['applied'], response.json['duplicates']), (1, 0))
+        self.assertEqual(self.sync_batch(['1'], vocable_id=other_vocable_id).json['duplicates'], 1)
+
+    def test_practice_sync_statements_do_not_grow_with_the_batch(self):
+        with app.app_context():
+            user = db.session.get(User, 1)
+            user.vocables.extend(Vocable(en=f'en-{i}', de=f'de-{i}') for i in range(20))
+            db.session.commit()
+            german = language_registry.by_iso('de')
+            counts = []
+            for size in (2, 20):
+                results = parse_results({'version': 1, 'results': [
+                    {'key': f'{size}-{i}', 'vocable_id': i + 2, 'correct': i % 2 == 0,
+                     'timestamp': datetime(2024, 1, size + i % 2).isoformat()} for i in range(size)]}, 500)
+                with count_queries() as statements:
+                    self.assertEqual(apply_results(db.session, 1, german, results)['applied'], size)
+                    db.session.commit()
+                counts.append(len(statements))
+            # the statements grow with the number of days (statistics), not with the number of results
+            self.assertEqual(counts[0], counts[1])
+
+    def enable_admission(self, **config):
+        previous = {key: app.config[key] for key in config}
+        app.config.update(ADMISSION_CONTROL=True, **config)
+        admission_controller.configure(app.config)
+        def restore():
+            app.config.update(ADMISSION_CONTROL=False, **previous)
+            admission_controller.configure(app.config)
+        self.addCleanup(restore)
+
+    def test_saturated_expensive_class_is_shed(self):
+        self.enable_admission(ADMISSION_EXPENSIVE_LIMIT=1, ADMISSION_EXPENSIVE_WAIT=0)
+        expensive = admission_controller.classes[EXPENSIVE]
+        self.assertTrue(expensive.acquire())  # a login that is still hashing
+        try:
+            response = self.client.get('/api/practice_pack')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], str(app.config['ADMISSION_RETRY_AFTER']))
+            self.assertEqual(self.client.get('/api/new_vocable').status_code, 200)
+            self.assertEqual(self.client.get('/vocabulary?page=1000').status_code, 503)
+        finally:
+            expensive.release(0)
+        self.assertEqual(self.client.get('/api/practice_pack').status_code, 200)
+        metrics = admission_controller.metrics()
+        self.assertEqual((metrics['expensive']['shed_503'], metrics['expensive']['in_flight']), (2, 0))
+        self.assertEqual(metrics['practice']['admitted'], 1)
+
+    def test_expensive_requests_are_throttled_per_user(self):
+        self.enable_admission(ADMISSION_USER_BURST=2, ADMISSION_USER_RATE=0.01)
+        self.assertEqual(self.client.get('/api/practice_pack').status_code, 200)
+        self.assertEqual(self.client.get('/api/practice_pack').status_code, 200)
+        response = self.client.get('/api/practice_pack')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response.headers['Retry-After']), 90)
+        self.assertEqual(self.client.get('/api/new_vocable').status_code, 200)
+        self.login_admin()  # another bucket (IP address) before the login, afterwards the admin's
+        metrics = self.client.get('/admin/admission').json
+        self.assertEqual(metrics['classes']['expensive']['throttled_429'], 1)
+
+    def test_rejected_requests_are_logged(self):
+        self.enable_admission(ADMISSION_USER_BURST=1, ADMISSION_USER_RATE=0.01)
+        self.client.get('/api/practice_pack')
+        with self.assertLogs(app.logger, 'INFO') as logs:
+            response = self.client.get('/api/practice_pack', headers={'X-Request-ID': 'abc'})
+        self.assertEqual((response.status_code, response.headers['X-Request-ID']), (429, 'abc'))
+        line = json.loads(JsonFormatter().format(logs.records[-1]))
+        self.assertEqual((line['route'], line['status']), ('/api/practice_pack', 429))
+        self.assertGreater(line['latency_ms'], 0)
+
+    def test_only_submitted_forms_are_expensive(self):
+        self.enable_admission(ADMISSION_USER_BURST=1, ADMISSION_USER_RATE=0.01)
+        self.client.get('/logout')
+        for _ in range(3):
+            self.assertEqual(self.client.get('/login').status_code, 200)
+        login = {'username': 'Testuser', 'password': 'wrong'}
+        self.assertEqual(self.client.post('/login', data=login, headers={'X-Forwarded-For': '10.0.0.1'}).status_code, 302)
+        self.assertEqual(self.client.post('/login', data=login, headers={'X-Forwarded-For': '10.0.0.1'}).status_code, 429)
+        # another client behind the same proxy
+        self.assertEqual(self.client.post('/login', data=login, headers={'X-Forwarded-For': '10.0.0.2'}).status_code, 302)
+
+class LoggingCase(unittest.TestCase):
+
+    def test_full_queue_drops_records(self):
+        handler = BoundedQueueHandler(2, logging.NullHandler())
+        handler._pid = os.getpid()  # no listener takes the records out of the queue
+        logger = logging.getLogger('tests.dropped')
+        logger.addHandler(handler)
+        for i in range(5):
+            logger.warning('record %d', i)
+        logger.removeHandler(handler)
+        self.assertEqual(handler.dropped, 3)
+        self.assertEqual(handler.queue.qsize(), 2)
+
+    def test_error_emails_are_rate_limited(self):
+        handler = RateLimitedSMTPHandler('localhost', 'from@example.com', ['to@example.com'], 'Failure', interval=60)
+        with mock.patch('smtplib.SMTP') as smtp:
+            for i in range(3):
+                handler.emit(logging.makeLogRecord({'msg': f'error {i}', 'levelno': logging.ERROR}))
+            self.assertEqual(smtp.return_value.send_message.call_count, 1)
+            self.assertEqual(handler.suppressed, 2)
+            handler._next_email = 0
+            self.assertIn('2 more errors', handler.getSubject(None))
+
+
+class QueryPlanCase(unittest.TestCase):
+
+    def test_hot_queries_use_indexes(self):
+        plans, report = query_plans.run()
+        for database, database_plans in plans.items():
+            for plan in database_plans:
+                self.assertEqual(plan.violations, [], f'{database}: {plan.query.name}, see {report}')
+
+    def test_full_scans_and_sorts_are_detected(self):
+        engine = sa.create_engine('sqlite://')
+        db.metadata.create_all(engine)
+        with engine.connect() as connection:
+            _, violations = query_plans.explain_sqlite(connection, "SELECT * FROM vocable WHERE de = 'x' ORDER BY en")
+        self.assertEqual(violations, ['full table scan of vocable', 'ORDER BY'])
+
+
+class ReplicaCase(LoggedInCase):
+
+    def setUp(self):
+        super().setUp()
+        # the replica is a copy of the primary database file with a changed word
+        with app.app_context():
+            primary_path = db.engine.url.database
+        self.replica_path = primary_path + '.replica'
+        shutil.copy(primary_path, self.replica_path)
+        app.config['SQLALCHEMY_REPLICA_URIS'] = ['sqlite:///' + self.replica_path]
+        replica_router.reset()
+        fragment_cache.clear()
+        with replica_router.engine(app.config['SQLALCHEMY_REPLICA_URIS'][0]).begin() as connection:
+            connection.execute(sa.update(Vocable).values(de='hallo (replica)', version_id=Vocable.version_id + 1))
+        with app.app_context():
+            replica_router.check_health()
+
+    def tearDown(self):
+        app.config['SQLALCHEMY_REPLICA_URIS'] = []
+        replica_router.reset()
+        os.remove(self.replica_path)
+        super().tearDown()
+
+    def expire_sticky_window(self):
+        with self.client.session_transaction() as session:
+            session.pop(STICKY_KEY, None)
+
+    def words(self, url):
+        return [v['de'] for v in self.client.get(url).json['vocables']]
+
+    def test_reads_stick_to_primary_after_write(self):
+        # config_practice in setUp was a write
+        self.assertEqual(self.words('/api/vocabulary'), ['hallo'])
+        self.expire_sticky_window()
+        self.assertEqual(self.words('/api/vocabulary'), ['hallo (replica)'])
+        self.assertIn('hallo (replica)', self.client.get('/vocabulary').text)
+        self.client.get('/api/new_vocable')
+        self.assertEqual(self.words('/api/vocabulary'), ['hallo'])
+
+    def test_writes_go_to_primary(self):
+        self.expire_sticky_window()
+        self.client.post('/delete_vocables', data={'vocable_ids': [1]})
+        with app.app_context():
+            self.assertEqual(db.session.scalar(sa.select(sa.func.count(Vocable.id))), 0)
+        self.expire_sticky_window()
+        self.assertEqual(self.words('/api/vocabulary'), ['hallo (replica)'])
+
+    def test_unhealthy_replica_falls_back_to_primary(self):
+        app.config['SQLALCHEMY_REPLICA_URIS'] = ['sqlite:////nonexistent/replica.db']
+        with app.app_context():
+            replica_router.check_health()
+            self.assertFalse(replica_router.is_healthy(app.config['SQLALCHEMY_REPLICA_URIS'][0]))
+        self.expire_sticky_window()
+        self.assertEqual(self.words('/api/vocabulary'), ['hallo'])
+
+    def test_replicas_are_checked_in_the_background(self):
+        uri = app.config['SQLALCHEMY_REPLICA_URIS'][0]
+        replica_router.reset()
+        self.expire_sticky_window()
+        threads = []
+        check_health = replica_router.check_health
+        def record_thread():
+            threads.append(threading.current_thread().name)
+            check_health()
+        with mock.patch.object(replica_router, 'check_health', record_thread):
+            with app.app_context():
+                # an unchecked replica is not used, the lookup wakes the health check thread up
+                self.assertFalse(replica_router.is_healthy(uri))
+                for _ in range(100):
+                    if replica_router.is_healthy(uri):
+                        break
+                    time.sleep(0.05)
+            self.expire_sticky_window()
+            self.assertEqual(self.words('/api/vocabulary'), ['hallo (replica)'])
+        # neither the request threads nor the event loop connect for a health check
+        self.assertEqual(set(threads), {'replica-health'})
+
+
+def publish_keys(url, key, n):
+    bus = InvalidationBus(url)
+    for _ in range(n):
+        bus.publish(key)
+
+def watch_keys(url, ready, results):
+    bus = InvalidationBus(url)
+    seen = []
+    bus.subscribe('user:', lambda key, generation: seen.append((key, generation)))
+    bus.poll(force=True)
+    ready.set()
+    deadline = datetime.now() + timedelta(seconds=10)
+    while not seen and datetime.now() < deadline:
+        bus.poll(force=True)
+    results.put(seen)
+
+
+class FakeRedis:
+    '''
+    In-memory stand-in for the redis client of the RedisBackend: one hash and one stream.
+    '''
+
+    def __init__(self):
+        self.hash, self.entries, self.sequence = {}, [], 0
+
+    def hincrby(self, name, key, amount):
+        self.hash[key] = self.hash.get(key, 0) + amount
+        return self.hash[key]
+
+    def hget(self, name, key):
+        return self.hash.get(key)
+
+    def xadd(self, name, fields, maxlen, approximate):
+        self.sequence += 1
+        self.entries.append((f'1700000000000-{self.sequence}', {key: str(value) for key, value in fields.items()}))
+        del self.entries[:-maxlen]
+
+    def xrange(self, name, min='-', max='+'):
+        def after_min(id):
+            if min.startswith('('):
+                return stream_id(id) > stream_id(min[1:])
+            return min == '-' or stream_id(id) >= stream_id(min)
+        return [(id, fields) for id, fields in self.entries 
+                if after_min(id) and (max == '+' or stream_id(id) <= stream_id(max))]
+
+    def xrevrange(self, name, count):
+        return self.entries[::-1][:count]
+
+    def xinfo_stream(self, name):
+        return {'first-entry': self.entries[0] if self.entries else None}
+
+
+class InvalidationCase(unittest.TestCase):
+
+    def setUp(self):
+        self.url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bus.db')
+        self.bus = InvalidationBus(self.url)
+        self.context = multiprocessing.get_context('fork')
+
+    def test_generations_are_counted_across_processes(self):
+        processes = [self.context.Process(target=publish_keys, args=(self.url, 'user:1', 10)) for _ in range(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual(self.bus.generation('user:1'), 30)
+        self.assertEqual(self.bus.generation('user:2'), 0)
+
+    def test_subscriber_in_other_process_is_called(self):
+        ready, results = self.context.Event(), self.context.Queue()
+        watcher = self.context.Process(target=watch_keys, args=(self.url, ready, results))
+        watcher.start()
+        self.assertTrue(ready.wait(10))
+        self.bus.publish('languages')
+        self.bus.publish('user:7')
+        self.assertEqual(results.get(timeout=10), [('user:7', 1)])
+        watcher.join()
+
+    def test_missed_events_drop_everything(self):
+        seen = []
+        watcher = InvalidationBus(self.url)
+        watcher.subscribe('user:', lambda key, generation: seen.append(key))
+        watcher.poll(force=True)
+        self.bus.backend.keep_events = 1
+        for _ in range(1000):
+            self.bus.publish('user:1')
+        self.assertEqual(watcher.poll(force=True), 1)
+        self.assertEqual(seen, [None, 'user:1'])
+
+
+class RedisBackendCase(unittest.TestCase):
+
+    def setUp(self):
+        redis = mock.Mock()
+        redis.Redis.from_url.return_value = FakeRedis()
+        with mock.patch.dict(sys.modules, {'redis': redis}):
+            self.bus = InvalidationBus('redis://localhost:6379/0')
+            self.watcher = InvalidationBus('redis://localhost:6379/0')
+        self.seen = []
+        self.watcher.subscribe('user:', lambda key, generation: self.seen.append((key, generation)))
+        self.watcher.poll(force=True)
+
+    def test_events_are_dispatched(self):
+        self.bus.publish('user:1')
+        self.bus.publish('user:1')
+        self.assertEqual(self.watcher.poll(force=True), 2)
+        self.assertEqual(self.bus.generation('user:1'), 2)
+        self.assertEqual(self.seen, [('user:1', 1), ('user:1', 2)])
+
+    def test_missed_events_drop_everything(self):
+        self.bus.publish('user:1')
+        self.watcher.poll(force=True)
+        self.bus.backend.keep_events = 2
+        for _ in range(5):
+            self.bus.publish('user:2')
+        self.assertEqual(self.watcher.poll(force=True), 2)
+        self.assertEqual(self.seen, [('user:1', 1), (None, 0), ('user:2', 4), ('user:2', 5)])
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
 